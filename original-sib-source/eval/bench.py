@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Builds one commit and variant repeatedly with several managers and compares their overhead
+
+Every manager builds the same configuration from a clean tree, first with cold and then with warm caches. The
+table lists median and p95 of build_t and plugin_t, the bytes of o-info files written and the time of the mpc
+dump, e.g. to compare linux_gt.py (no plugin) and linux.py before an evaluation run:
+
+    ./bench.py /linux -c v6.1 -m linux_gt.py -m linux.py -p /plugin.so -t /mpc --compiler clang-15 --dump-dir /tmp/bench
+"""
+
+import os
+import csv
+import sys
+import time
+import random
+import logging
+import argparse
+import statistics
+
+from eval import Git, ReadableDir
+from projectmanager import ProjectManager
+
+COLUMNS = ['manager', 'cache', 'runs', 'build_t_median', 'build_t_p95', 'build_t_ratio', 'plugin_t_median',
+           'plugin_t_p95', 'info_bytes', 'dump_t_median', 'dump_t_p95']
+
+
+def drop_caches():
+    """Drops the page cache, returns False without root"""
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3')
+        return True
+    except OSError:
+        return False
+
+
+def info_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            if file.endswith('.o-info'):
+                total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+def store_bytes():
+    """Size of the records in SIB_INFO_STORE, which is shared by all builds and only grows"""
+    store = os.environ.get('SIB_INFO_STORE')
+    if not store or not os.path.isdir(store):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(store))
+
+
+def p95(values):
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=20, method='inclusive')[-1]
+
+
+def bench(git, commit, project, runs, cold):
+    """Yields build_t, plugin_t, info bytes and dump_t (None without plugin) of every run"""
+    git.checkout(commit)
+    for _ in range(runs):
+        git.reset()
+        git.clean()
+        project.config()
+        if cold and not drop_caches():
+            logging.warning('Cannot drop the page cache, cold runs only start from a clean tree')
+            cold = False
+
+        stored = store_bytes()
+        p, build_t, plugin_t = project.timed_build()
+        # only the records this build added to the store count
+        written = info_bytes(git.path) + store_bytes() - stored
+
+        dump_t = None
+        if written and project.tool:
+            project.compile_commands(p.stdout.encode() if p else None)
+            start = time.monotonic()
+            p = project.multipatchcheck(commit, variant_aware=True)
+            dump_t = time.monotonic() - start
+            if p.returncode != 0:
+                logging.error('mpc dump failed: %s', p.stderr)
+
+        project.pop_spans()
+        yield build_t, plugin_t, written, dump_t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('repository', action=ReadableDir)
+    parser.add_argument('-c', '--commit', required=True)
+    parser.add_argument('-m', '--manager', action='append', required=True,
+                        help="may be repeated, the first one is the baseline of build_t_ratio")
+    parser.add_argument('-p', '--plugin')
+    parser.add_argument('-t', '--tool')
+    parser.add_argument('--compiler')
+    parser.add_argument('--dump-dir', required=True)
+    parser.add_argument('--runs', type=int, default=3, help="builds per manager and cache state")
+    parser.add_argument('--variant', type=int, default=0, help="index of the random variant to build")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), help="also write the table as CSV")
+    parser.add_argument('-d', '--debug', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    args.repository = os.path.abspath(args.repository)
+    git = Git(args.repository)
+
+    projects = []
+    for manager in args.manager:
+        dump_dir = os.path.join(os.path.abspath(args.dump_dir), os.path.splitext(os.path.basename(manager))[0])
+        os.makedirs(os.path.join(dump_dir, 'info'), exist_ok=True)
+        projects.append(ProjectManager.load(manager)(args.repository, args.plugin, args.tool, args.compiler,
+                                                     dump_dir))
+
+    os.chdir(git.path)
+    rows = []
+    baseline = {}
+    for manager, project in zip(args.manager, projects):
+        # every manager builds the same variant
+        random.seed(args.seed)
+        project.variant = project.get_random_variants(args.variant + 1)[args.variant]
+
+        for cache in ['cold', 'warm']:
+            logging.info('%s: %d %s builds', manager, args.runs, cache)
+            build_ts, plugin_ts, written, dump_ts = zip(*bench(git, args.commit, project, args.runs,
+                                                               cache == 'cold'))
+            dump_ts = [t for t in dump_ts if t is not None]
+
+            build_median = statistics.median(build_ts)
+            baseline.setdefault(cache, build_median)
+            rows.append([
+                os.path.basename(manager), cache, args.runs,
+                f'{build_median:.3f}', f'{p95(build_ts):.3f}', f'{build_median / baseline[cache]:.3f}',
+                f'{statistics.median(plugin_ts):.3f}', f'{p95(plugin_ts):.3f}', max(written),
+                f'{statistics.median(dump_ts):.3f}' if dump_ts else '', f'{p95(dump_ts):.3f}' if dump_ts else '',
+            ])
+
+    widths = [max(len(str(row[i])) for row in [COLUMNS] + rows) for i in range(len(COLUMNS))]
+    for row in [COLUMNS] + rows:
+        print('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+    if args.output:
+        writer = csv.writer(args.output)
+        writer.writerows([COLUMNS] + rows)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
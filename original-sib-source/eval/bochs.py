@@ -99,6 +99,13 @@ class BochsManager(ProjectManager):
         subprocess.run(argv, env=my_env, cwd='bochs', check=True, stdout=DEVNULL)
         # subprocess.run(argv, env=my_env, cwd='bochs', check=True)
 
+    def get_config_inputs(self):
+        return [
+            'bochs/configure',
+            'bochs/config.h.in',
+            ':(glob)bochs/**/Makefile.in',
+        ]
+
     def build(self):
         my_env = os.environ.copy()
         my_env['SOURCE_DATE_EPOCH'] = '1'
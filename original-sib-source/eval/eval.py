@@ -2,20 +2,33 @@
 
 import os
 import sys
+import json
 import time
 import random
+import shutil
 import logging
 import argparse
+import tempfile
+import traceback
 import subprocess
+import multiprocessing
 
 from subprocess import DEVNULL
 from projectmanager import ProjectManager
 
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
 
 class Git:
 
     def __init__(self, path):
         self.path = path
+        # the commit checked out last, tracked files are cached per commit
+        self.head = None
+        self.__tracked = (None, None)
 
     def checkout(self, commit):
         logging.debug('git checkout %s', commit)
@@ -24,6 +37,7 @@ class Git:
                        check=True,
                        stdout=DEVNULL,
                        stderr=DEVNULL)
+        self.head = commit
 
     def apply(self, commit):
         logging.debug('Applying %s', commit)
@@ -62,6 +76,103 @@ class Git:
                        check=True,
                        stdout=DEVNULL)
 
+    def diff_stat(self):
+        """Returns `git diff --stat` of the unstaged changes"""
+        p = subprocess.run(['git', 'diff', '--stat'],
+                           cwd=self.path,
+                           check=True,
+                           text=True,
+                           capture_output=True)
+        return p.stdout
+
+    def ls_files(self):
+        """Returns the paths in the index, applied changes stay unstaged so they only change on checkout"""
+        if self.head is None or self.__tracked[0] != self.head:
+            self.__tracked = (self.head, self.list_tracked())
+        return self.__tracked[1]
+
+    def list_tracked(self):
+        p = subprocess.run(['git', 'ls-files'], cwd=self.path, check=True, text=True, capture_output=True)
+        return p.stdout.splitlines()
+
+    def add_worktree(self, path, commit):
+        logging.debug('git worktree add %s', path)
+        subprocess.run(['git', 'worktree', 'add', '--force', '--detach', path, commit],
+                       cwd=self.path,
+                       check=True,
+                       stdout=DEVNULL,
+                       stderr=DEVNULL)
+        return type(self)(os.path.realpath(path))
+
+    def open_worktree(self, path, commit):
+        if os.path.isdir(path):
+            return type(self)(os.path.realpath(path))
+        return self.add_worktree(path, commit)
+
+    def remove_worktree(self, path):
+        logging.debug('git worktree remove %s', path)
+        subprocess.run(['git', 'worktree', 'remove', '--force', path],
+                       cwd=self.path,
+                       check=True,
+                       stdout=DEVNULL,
+                       stderr=DEVNULL)
+
+
+class LibGit(Git):
+    """Git backend that keeps the repository open in-process through pygit2 instead of spawning git
+
+    Revision ranges and worktrees are still handled by the git command line, both are rare.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.repo = pygit2.Repository(path)
+
+    def __commit(self, commit):
+        return self.repo.revparse_single(commit).peel(pygit2.Commit)
+
+    def checkout(self, commit):
+        logging.debug('checkout %s', commit)
+        target = self.__commit(commit)
+        # only files that differ from the index are written
+        self.repo.checkout_tree(target, strategy=pygit2.GIT_CHECKOUT_FORCE)
+        self.repo.set_head(target.id)
+        self.head = commit
+
+    def apply(self, commit):
+        logging.debug('Applying %s', commit)
+        change = self.__commit(commit)
+        # like cherry-pick -m1 followed by reset, the changes against the first parent end up unstaged
+        diff = self.repo.diff(change.parents[0], change, flags=pygit2.GIT_DIFF_SHOW_BINARY)
+        self.repo.apply(diff, pygit2.GIT_APPLY_LOCATION_WORKDIR)
+
+    def clean(self):
+        logging.debug('clean -dfx')
+        status = self.repo.status(untracked_files='normal', ignored=True)
+        for path, flags in status.items():
+            if not flags & (pygit2.GIT_STATUS_WT_NEW | pygit2.GIT_STATUS_IGNORED):
+                continue
+
+            path = os.path.join(self.path, path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                # like git clean without -ff, nested repositories (e.g. worktrees) are kept
+                if not os.path.exists(os.path.join(path, '.git')):
+                    shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    def reset(self):
+        logging.debug('reset --hard')
+        self.repo.reset(self.repo.head.target, pygit2.GIT_RESET_HARD)
+
+    def diff_stat(self):
+        return self.repo.diff().stats.format(pygit2.GIT_DIFF_STATS_FULL, 80)
+
+    def list_tracked(self):
+        index = self.repo.index
+        index.read(False)
+        return [entry.path for entry in index]
+
 
 class ReadableDir(argparse.Action):
 
@@ -77,22 +188,15 @@ class ReadableDir(argparse.Action):
                 f"readable_dir:{prospective_dir} is not a readable dir")
 
 
-def run(git, commits, project, clean, skip_initial_clean, num_variants):
-    commits = git.list(commits)
+def run_variants(git, commits, project, variants, variant_indices, clean, skip_initial_clean, workspaces=None,
+                 done=frozenset()):
     num_commits = len(commits)
+    reconfigure = False
 
-    variants = project.get_random_variants(num_variants)
-
-    if project.dump_dir:
-        os.makedirs(os.path.join(project.dump_dir, 'info'), exist_ok=True)
-
-    logging.info('Setting up repository...')
     os.chdir(git.path)
-
-    results = [['Index', 'Commit', 'Variant', 'config_t'] + project.header()]
-    git.reset()
-
-    var_table = {}
+    if not workspaces:
+        with project.span('reset'):
+            git.reset()
 
     for i, base_commit in enumerate(commits):
         if i + 1 == num_commits:
@@ -101,38 +205,320 @@ def run(git, commits, project, clean, skip_initial_clean, num_variants):
         change_commit = commits[i + 1]
 
         logging.info("[%d/%d] %s", i + 1, num_commits - 1, change_commit)
-        git.checkout(base_commit)
+        if all((i, variant_idx) in done for variant_idx in variant_indices):
+            logging.info('Already done, skipping')
+            reconfigure = True
+            continue
+
+        if not workspaces:
+            with project.span('checkout'):
+                git.checkout(base_commit)
 
-        for variant_idx in range(0, num_variants):
+        for variant_idx in variant_indices:
             config = variants[variant_idx]
             project.variant = config
             variant_id = project.get_variant_id()
-            var_table[variant_id] = config
+
+            if (i, variant_idx) in done:
+                logging.debug("Variant %d already done, skipping", variant_idx)
+                reconfigure = True
+                continue
+
+            # the build of the previous commit carries over if mpc predicts base_commit not to affect it
+            carried = project.carry_forward(commits[i - 1], base_commit) if project.skip_unaffected and i else None
+            if carried is not None:
+                logging.debug("Variant %d is not affected, skipping its build", variant_idx)
+                reconfigure = True
+                row = [i, change_commit, variant_id, 0] + carried
+                yield i, variant_idx, row, project.pop_spans(), project.pop_artifacts()
+                continue
 
             logging.debug("Setting variant %d: %s", variant_idx, " ".join(config))
 
-            if i == 0 or clean:
-                if not skip_initial_clean:
-                    git.reset()
-                    git.clean()
+            if workspaces:
+                workspace = workspaces[variant_idx]
+                os.chdir(workspace.path)
+                project.path = workspace.path
+                with project.span('checkout'):
+                    workspace.checkout(base_commit)
 
-                start = time.monotonic()
-                project.config()
-                end = time.monotonic()
+                start, end = config_workspace(workspace, project)
+                git_used = workspace
             else:
-                start = 0
-                end = 0
+                # after a skipped pair the build directory no longer matches the previous commit
+                if i == 0 or clean or reconfigure:
+                    reconfigure = False
+                    if not skip_initial_clean:
+                        with project.span('reset'):
+                            git.reset()
+                        with project.span('clean'):
+                            git.clean()
+
+                    start = time.monotonic()
+                    with project.span('config'):
+                        project.config()
+                    end = time.monotonic()
+                else:
+                    start = 0
+                    end = 0
+                git_used = git
+
+            row = [i, change_commit, variant_id, end - start] + \
+                project.run(git_used, base_commit, change_commit, variant_idx)
+            yield i, variant_idx, row, project.pop_spans(), project.pop_artifacts()
+
+
+def config_workspace(workspace, project):
+    # the build directory of a variant is kept across commits and only reconfigured if its inputs changed
+    stamp_path = workspace.path + '.stamp'
+    stamp = project.get_config_stamp()
+
+    if os.path.exists(stamp_path):
+        with open(stamp_path, 'r') as f:
+            if f.read() == stamp:
+                return 0, 0
+        logging.debug('Configuration of %s is stale', workspace.path)
+
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+    with project.span('reset'):
+        workspace.reset()
+    with project.span('clean'):
+        workspace.clean()
+
+    start = time.monotonic()
+    with project.span('config'):
+        project.config()
+    end = time.monotonic()
+
+    with open(stamp_path, 'w') as f:
+        f.write(stamp)
+
+    return start, end
+
+
+def run_worker(git, commits, project, variants, variant_indices, clean, skip_initial_clean, workspaces, done,
+               queue):
+    project.path = git.path
+    try:
+        for row in run_variants(git, commits, project, variants, variant_indices, clean, skip_initial_clean,
+                                workspaces, done):
+            queue.put(row)
+    except BaseException:
+        queue.put(traceback.format_exc())
+    finally:
+        project.close_daemon()
+        queue.put(None)
+
+
+def run_parallel(git, commits, project, variants, clean, skip_initial_clean, num_workers, worktree_dir,
+                 workspaces=None, done=frozenset()):
+    num_workers = min(num_workers, len(variants))
+
+    # split the cores between the workers instead of oversubscribing with -j$(nproc) each
+    project.jobs = str(max(1, os.cpu_count() // num_workers))
+
+    # persistent workspaces are per variant, otherwise every worker gets a temporary one
+    if workspaces:
+        worktrees = [git] * num_workers
+    else:
+        os.makedirs(worktree_dir, exist_ok=True)
+        worktrees = [
+            git.add_worktree(os.path.join(worktree_dir, str(worker)), commits[0])
+            for worker in range(num_workers)
+        ]
+
+    queue = multiprocessing.Queue()
+    workers = []
+    for worker, worktree in enumerate(worktrees):
+        # a variant is always built by the same worker, so the build paths stay stable across commits
+        variant_indices = range(worker, len(variants), num_workers)
+        workers.append(
+            multiprocessing.Process(target=run_worker,
+                                    args=(worktree, commits, project, variants, variant_indices, clean,
+                                          skip_initial_clean, workspaces, done, queue)))
+
+    for worker in workers:
+        worker.start()
+
+    pending = {}
+    order = [(i, variant_idx) for i in range(len(commits) - 1) for variant_idx in range(len(variants))
+             if (i, variant_idx) not in done]
+    running = len(workers)
+    try:
+        while running:
+            item = queue.get()
+            if item is None:
+                running -= 1
+                continue
+            if isinstance(item, str):
+                raise RuntimeError(f'worker failed:\n{item}')
+
+            i, variant_idx, *result = item
+            pending[(i, variant_idx)] = result
+
+            # emit rows in the same order as a serial run
+            while order and order[0] in pending:
+                key = order.pop(0)
+                yield (*key, *pending.pop(key))
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+        os.chdir(git.path)
+        if not workspaces:
+            for worktree in worktrees:
+                git.remove_worktree(worktree.path)
+
+
+def run(git, commits, project, clean, skip_initial_clean, num_variants, parallel_variants=1, worktree_dir=None,
+        persistent_variants=False, batch_check=False, phase_columns=False, trace=None, output=None, resume=False):
+    commits = git.list(commits)
+
+    variants = project.get_variants(num_variants)
+
+    if project.dump_dir:
+        os.makedirs(os.path.join(project.dump_dir, 'info'), exist_ok=True)
 
-            results += [
-                [i, change_commit, variant_id, end - start] +
-                project.run(git, base_commit, change_commit, variant_idx)
-            ]
+    logging.info('Setting up repository...')
+
+    header = ['Index', 'Commit', 'Variant', 'config_t'] + project.header()
+    results = [header + [f'{phase}_phase_t' for phase in project.PHASES] if phase_columns else header]
+    write_rows(output, results)
+
+    var_table = {}
+    variant_ids = []
+    for config in variants:
+        project.variant = config
+        variant_ids.append(project.get_variant_id())
+        var_table[variant_ids[-1]] = config
+    if project.dump_dir:
+        project.record_variants(var_table)
+
+    # rows of earlier runs, keyed like the rows of this run
+    # build and check runs share dump directories, every manager keeps its own journal
+    journal_name = f'progress-{type(project).__name__}.jsonl'
+    journal_path = os.path.join(project.dump_dir, journal_name) if project.dump_dir else None
+    finished = load_journal(journal_path, commits, variant_ids, project) if resume else {}
+    if finished:
+        logging.info('Resuming, %d rows already done', len(finished))
+    journal = open(journal_path, 'a' if resume else 'w') if journal_path else None
+
+    if project.diff_cache:
+        logging.info('Computing the changes of all commits...')
+        with project.span('diff'):
+            project.precompute_diffs(list(zip(commits, commits[1:])))
+        spans = project.pop_spans()
+        if trace:
+            write_trace(trace, {'phase': 'diff', 'spans': spans})
+
+    if batch_check:
+        logging.info('Checking all commits...')
+        with project.span('mpc_check'):
+            project.check_batch(list(zip(commits, commits[1:])))
+        if trace:
+            write_trace(trace, {'phase': 'batch_check', 'spans': project.pop_spans()})
+
+    workspaces = None
+    if persistent_variants:
+        os.makedirs(worktree_dir, exist_ok=True)
+        workspaces = {
+            variant_idx: git.open_worktree(os.path.join(worktree_dir, variant_id), commits[0])
+            for variant_idx, variant_id in enumerate(var_table)
+        }
+
+    # emit_finished() pops from finished before the lazy runs look up what to skip
+    done = frozenset(finished)
+    if parallel_variants > 1:
+        rows = run_parallel(git, commits, project, variants, clean, skip_initial_clean, parallel_variants,
+                            worktree_dir, workspaces, done)
+    else:
+        rows = run_variants(git, commits, project, variants, range(num_variants), clean, skip_initial_clean,
+                            workspaces, done)
+
+    # rows are produced in order, the finished ones of an earlier run are merged in where they belong
+    order = [(i, variant_idx) for i in range(len(commits) - 1) for variant_idx in range(len(variants))]
+
+    def emit_finished():
+        while order and order[0] in finished:
+            i, variant_idx = order.pop(0)
+            row, spans = finished.pop((i, variant_idx))
+            if phase_columns:
+                # failed builds return short rows, pad them so the phase columns stay aligned
+                row = row + [''] * (len(header) - len(row)) + [spans.get(phase, '') for phase in project.PHASES]
+            results.append(row)
+            write_rows(output, [row])
+
+            # all variants of the commit are dumped
+            if variant_idx + 1 == len(variants) and project.tool and project.dump_dir:
+                project.compact(commits[i])
+                spans = project.pop_spans()
+                if trace and spans:
+                    write_trace(trace, {'phase': 'compact', 'commit': commits[i], 'spans': spans})
+
+    emit_finished()
+    for i, variant_idx, row, spans, artifacts in rows:
+        if journal:
+            journal.write(json.dumps({'base': commits[i], 'variant': row[2], 'row': row, 'spans': spans,
+                                      'artifacts': artifacts}) + '\n')
+            journal.flush()
+        if trace:
+            write_trace(trace, {'index': i, 'commit': row[1], 'variant': row[2], 'spans': spans})
+
+        finished[(i, variant_idx)] = (row, spans)
+        emit_finished()
+
+    if journal:
+        journal.close()
 
     print(var_table)
 
     return results
 
 
+def load_journal(path, commits, variant_ids, project):
+    """Returns the rows of an earlier run whose artifacts are still intact, keyed by (index, variant index)"""
+    finished = {}
+    if not os.path.exists(path):
+        return finished
+
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a killed run may be incomplete
+                continue
+
+            try:
+                i = commits.index(entry['base'])
+                variant_idx = variant_ids.index(entry['variant'])
+            except ValueError:
+                continue
+            if i + 1 == len(commits) or entry['row'][1] != commits[i + 1]:
+                continue
+            if not project.has_artifacts(entry['artifacts']):
+                logging.info('%s-%s failed or its artifacts are missing, rerunning', entry['base'], entry['variant'])
+                continue
+
+            finished[(i, variant_idx)] = (entry['row'], entry['spans'])
+
+    return finished
+
+
+def write_rows(output, rows):
+    if output:
+        output.writelines(map(format_result, rows))
+        output.flush()
+
+
+def write_trace(trace, record):
+    trace.write(json.dumps(record) + '\n')
+    trace.flush()
+
+
 def format_result(commit, sep=',', end='\n'):
 
     def format_inner(element):
@@ -164,8 +550,56 @@ def main():
     parser.add_argument('--dump-dir')
     parser.add_argument('--num-variants', type=int, default=1)
     parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--parallel-variants', type=int, default=1,
+                        help="build variants in N workers, each in its own git worktree")
+    parser.add_argument('--persistent-variants', action='store_true',
+                        help="keep one worktree per variant and build incrementally across commits")
+    parser.add_argument('--batch-check', action='store_true',
+                        help="run the mpc checks of all commits in a single process")
+    parser.add_argument('--worktree-dir', help="where to place the worktrees of --parallel-variants and --persistent-variants")
+    parser.add_argument('--storage-format', choices=['json', 'binary'], default='json',
+                        help="format of the line range databases mpc dumps")
+    parser.add_argument('--info-from-compile-commands', action='store_true',
+                        help="let mpc read the o-info files of the compile commands instead of searching the tree")
+    parser.add_argument('--info-store', action='store_true',
+                        help="let the plugin write records shared by translation units once to DUMP_DIR/info-store")
+    parser.add_argument('--object-cache', action='store_true',
+                        help="reuse objects and o-info files of identical compilations across variants and commits")
+    parser.add_argument('--git-backend', choices=['git', 'libgit2'], default='git',
+                        help="run git operations through the git command line or in-process with pygit2")
+    parser.add_argument('--diff-cache', action='store_true',
+                        help="compute the changes of every commit pair once up front and share them between checks")
+    parser.add_argument('--check-in-process', action='store_true',
+                        help="answer the mpc checks in-process with lrdb.py, from the LRDBs and the --diff-cache entries")
+    parser.add_argument('--mpc-daemon', action='store_true',
+                        help="run the mpc analyses in one long-running `mpc serve` instead of a process each")
+    parser.add_argument('--skip-unaffected', action='store_true',
+                        help="build a variant only if mpc predicts it to be affected since the previous commit")
+    parser.add_argument('--sampler', choices=['random', 'coverage'], default='random',
+                        help="pick the variants at random or to cover the most lines of the newest LRDB in DUMP_DIR")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the commits and variants that an earlier run with the same --dump-dir finished")
+    parser.add_argument('--phase-columns', action='store_true',
+                        help="append the time spent in every phase as extra columns")
+    parser.add_argument('--trace', type=argparse.FileType('w'),
+                        help="write the time spent in every phase as JSON lines to this file")
     args = parser.parse_args()
 
+    if args.resume and not args.dump_dir:
+        parser.error('--resume requires --dump-dir')
+    if args.info_store and not args.dump_dir:
+        parser.error('--info-store requires --dump-dir')
+    if args.object_cache and not (args.dump_dir and args.compiler):
+        parser.error('--object-cache requires --dump-dir and --compiler')
+    if args.skip_unaffected and not (args.dump_dir and args.tool):
+        parser.error('--skip-unaffected requires --dump-dir and --tool')
+    if args.diff_cache and not args.dump_dir:
+        parser.error('--diff-cache requires --dump-dir')
+    if args.check_in_process and not args.diff_cache:
+        parser.error('--check-in-process requires --diff-cache')
+    if args.git_backend == 'libgit2' and pygit2 is None:
+        parser.error('--git-backend libgit2 requires pygit2')
+
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -173,18 +607,49 @@ def main():
 
     random.seed(args.seed)
 
-    if args.num_variants > 1:
+    if args.num_variants > 1 and not args.persistent_variants:
         args.clean = True
 
-    git = Git(args.repository)
+    if (args.parallel_variants > 1 or args.persistent_variants) and not args.worktree_dir:
+        if args.dump_dir:
+            args.worktree_dir = os.path.join(args.dump_dir, 'worktrees')
+        else:
+            args.worktree_dir = tempfile.mkdtemp(prefix='sibx-worktrees-')
+
+    args.repository = os.path.abspath(args.repository)
+
+    if args.info_store:
+        # records are content addressed, so every variant and commit can share the store
+        store = os.path.abspath(os.path.join(args.dump_dir, 'info-store'))
+        os.makedirs(store, exist_ok=True)
+        os.environ['SIB_INFO_STORE'] = store
+
+    if args.object_cache:
+        # identical compilations of every variant and commit are hardlinked from the cache instead of compiled
+        cache = os.path.abspath(os.path.join(args.dump_dir, 'objcache'))
+        os.makedirs(cache, exist_ok=True)
+        os.environ['SIB_OBJCACHE'] = cache
+        args.compiler = f'{os.path.join(os.path.dirname(os.path.abspath(__file__)), "objcache.py")} {args.compiler}'
+
+    git = (LibGit if args.git_backend == 'libgit2' else Git)(args.repository)
     project_manger = ProjectManager.load(args.manager)(args.repository,
                                                        args.plugin, args.tool, args.compiler,
                                                        args.dump_dir)
-
-    results = run(git, args.commits, project_manger, args.clean,
-                  args.skip_initial_clean, args.num_variants)
-
-    args.output.writelines(map(format_result, results))
+    project_manger.storage_format = args.storage_format
+    project_manger.info_from_compile_commands = args.info_from_compile_commands
+    project_manger.use_daemon = args.mpc_daemon
+    project_manger.diff_cache = args.diff_cache
+    project_manger.check_in_process = args.check_in_process
+    project_manger.sampler = args.sampler
+    project_manger.skip_unaffected = args.skip_unaffected
+
+    try:
+        run(git, args.commits, project_manger, args.clean,
+            args.skip_initial_clean, args.num_variants, args.parallel_variants, args.worktree_dir,
+            args.persistent_variants, args.batch_check, args.phase_columns, args.trace, args.output,
+            args.resume)
+    finally:
+        project_manger.close_daemon()
 
 
 if __name__ == "__main__":
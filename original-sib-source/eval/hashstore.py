@@ -0,0 +1,140 @@
+import os
+import json
+import struct
+import sqlite3
+import logging
+
+# path id + blake2b digest
+RECORD = struct.Struct('<I64s')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS builds (
+    revision TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    objects BLOB NOT NULL,
+    PRIMARY KEY (revision, variant)
+) WITHOUT ROWID;
+'''
+
+
+class ObjectDiff:
+    """Difference between the objects of two builds, paths are given as interned ids"""
+
+    def __init__(self, added, removed, changed, unchanged):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.unchanged = unchanged
+
+    @property
+    def equal(self):
+        return not (self.added or self.removed or self.changed)
+
+    def counts(self):
+        return [len(self.added), len(self.removed), len(self.changed), self.unchanged]
+
+
+def diff_objects(base_objects, change_objects):
+    base_paths = base_objects.keys()
+    change_paths = change_objects.keys()
+
+    added = sorted(change_paths - base_paths)
+    removed = sorted(base_paths - change_paths)
+    changed = sorted(path_id for path_id, _ in base_objects.items() - change_objects.items()
+                     if path_id in change_objects)
+    unchanged = len(base_paths) - len(removed) - len(changed)
+
+    return ObjectDiff(added, removed, changed, unchanged)
+
+
+class HashStore:
+    """Object hashes of all builds in a single SQLite database.
+
+    Paths are interned, the objects of a (commit, variant) pair are stored as one packed table of path ids and
+    fixed-width digests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=600)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.__paths = {}
+
+    def __intern(self, paths):
+        missing = [(path,) for path in paths if path not in self.__paths]
+        if missing:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO paths (path) VALUES (?)', missing)
+            self.__paths.update(self.db.execute('SELECT path, id FROM paths'))
+
+        return [self.__paths[path] for path in paths]
+
+    def path_names(self, ids):
+        names = {path_id: path for path, path_id in self.__paths.items()}
+        if any(path_id not in names for path_id in ids):
+            self.__paths.update(self.db.execute('SELECT path, id FROM paths'))
+            names = {path_id: path for path, path_id in self.__paths.items()}
+
+        return [names[path_id] for path_id in ids]
+
+    def contains(self, commit, variant):
+        row = self.db.execute('SELECT 1 FROM builds WHERE revision = ? AND variant = ?', (commit, variant)).fetchone()
+        return row is not None
+
+    def put(self, commit, variant, object_hashes):
+        paths = sorted(object_hashes)
+        ids = self.__intern(paths)
+        objects = b''.join(RECORD.pack(path_id, bytes.fromhex(object_hashes[path])) for path, path_id in zip(paths, ids))
+
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO builds (revision, variant, objects) VALUES (?, ?, ?)',
+                            (commit, variant, objects))
+
+    def copy(self, commit, variant, to_commit):
+        """Stores the objects of (commit, variant) under to_commit as well"""
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO builds (revision, variant, objects) '
+                            'SELECT ?, variant, objects FROM builds WHERE revision = ? AND variant = ?',
+                            (to_commit, commit, variant))
+
+    @staticmethod
+    def __unpack(objects):
+        return dict(RECORD.iter_unpack(objects))
+
+    def get(self, commit, variant):
+        row = self.db.execute('SELECT objects FROM builds WHERE revision = ? AND variant = ?',
+                              (commit, variant)).fetchone()
+        return self.__unpack(row[0]) if row else None
+
+    def get_commit(self, commit):
+        rows = self.db.execute('SELECT variant, objects FROM builds WHERE revision = ?', (commit,))
+        return {variant: self.__unpack(objects) for variant, objects in rows}
+
+    def diff(self, base_commit, change_commit):
+        """Compares all variants of two commits in one pass, variants missing in change_commit map to None"""
+        base_variants = self.get_commit(base_commit)
+        change_variants = self.get_commit(change_commit)
+
+        return {
+            variant: diff_objects(base_objects, change_variants[variant]) if variant in change_variants else None
+            for variant, base_objects in base_variants.items()
+        }
+
+    def import_json(self, dump_dir, commit):
+        """Imports the *-hashes.json files of earlier evaluation runs"""
+        for entry in os.listdir(dump_dir):
+            if not entry.startswith(commit) or not entry.endswith('-hashes.json'):
+                continue
+
+            _, variant, _ = entry.split('-')
+            if self.contains(commit, variant):
+                continue
+
+            logging.debug('Importing %s', entry)
+            with open(os.path.join(dump_dir, entry), 'r') as f:
+                self.put(commit, variant, json.load(f))
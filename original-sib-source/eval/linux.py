@@ -13,6 +13,12 @@ class LinuxManager(ProjectManager):
         # 'randconfig',
     ]
 
+    BUILD_FILES = ProjectManager.BUILD_FILES + [
+        ':(glob)**/Kbuild',
+        ':(glob)**/Kconfig*',
+        'scripts/',
+    ]
+
     ALARM_LIST = [
         'arch/x86/entry/vdso/vdso2c.c',
         'arch/x86/entry/vdso/vdso2c.h',
@@ -100,6 +106,13 @@ class LinuxManager(ProjectManager):
 
         self.__discard_staged_changes()
 
+    def get_config_inputs(self):
+        return [
+            ':(glob)**/Kconfig*',
+            'scripts/kconfig/',
+            f'/config/{self.variant}',
+        ]
+
     def get_ignore_patterns(self):
         files = [
             'tools/',
@@ -124,5 +137,9 @@ class LinuxManager(ProjectManager):
 
         return configs
 
+    def get_coverage_variants(self, count):
+        # the configurations are not made of flags, there is nothing to choose from
+        return self.get_random_variants(count)
+
 
 MANAGER = LinuxManager
@@ -0,0 +1,261 @@
+import os
+import sys
+import mmap
+import json
+import struct
+import bisect
+from array import array
+
+EXTENSIONS = ['lrdb', 'json']
+
+VERSION = 2
+HEADER = struct.Struct('<4sIIIIII')
+U32 = struct.Struct('<I')
+FILE_RANGE = struct.Struct('<III')
+
+
+class FileIndex:
+    """Used line segments of one file, sorted by start like a Lapper
+
+    Every segment refers to a variant bitset in the shared `sets` table.
+    """
+
+    __slots__ = ('starts', 'stops', 'values', 'max_len', 'sets')
+
+    def __init__(self, starts, stops, values, max_len, sets):
+        self.starts = starts
+        self.stops = stops
+        self.values = values
+        self.max_len = max_len
+        self.sets = sets
+
+    @classmethod
+    def from_segments(cls, segments, sets):
+        segments = sorted(segments)
+        return cls(array('I', (start for start, _, _ in segments)), array('I', (stop for _, stop, _ in segments)),
+                   array('I', (value for _, _, value in segments)),
+                   max((stop - start for start, stop, _ in segments), default=0), sets)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, start, stop):
+        """Returns the union of the variant bitsets of all segments overlapping [start, stop)"""
+        lo = bisect.bisect_left(self.starts, max(0, start - self.max_len))
+        hi = bisect.bisect_left(self.starts, stop)
+
+        used = 0
+        for i in range(lo, hi):
+            if self.stops[i] > start:
+                used |= self.sets[self.values[i]]
+        return used
+
+    def all(self):
+        used = 0
+        for value in set(self.values):
+            used |= self.sets[value]
+        return used
+
+    def used_lines(self):
+        return sum(stop - start for start, stop in zip(self.starts, self.stops))
+
+
+def words_to_int(words):
+    return sum(word << (64 * i) for i, word in enumerate(words))
+
+
+class LRDB:
+    """In-process view of the line range database (`{commit}.json`) that mpc accumulates per commit
+
+    Bit `i` of a variant bitset refers to `variants[i]`, `files` maps every used file to its FileIndex.
+    """
+
+    def __init__(self, repo, files, variants, commands):
+        self.repo = repo
+        self.files = files
+        self.variants = variants
+        self.commands = commands
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith('.lrdb'):
+            return cls.load_binary(path)
+
+        with open(path, 'r', encoding='utf8') as f:
+            js = json.load(f)
+
+        sets = []
+        ids = {}
+        # databases written before the variants were stored as bitsets name the variant of every interval
+        legacy = 'variants' not in js
+        variants = sorted(js['commands']) if legacy else js['variants']
+        bits = {variant: i for i, variant in enumerate(variants)}
+
+        def intern(val):
+            if legacy:
+                if val not in bits:
+                    bits[val] = len(variants)
+                    variants.append(val)
+                used = 1 << bits[val]
+            else:
+                used = words_to_int(val)
+            if used not in ids:
+                ids[used] = len(sets)
+                sets.append(used)
+            return ids[used]
+
+        files = {
+            path: FileIndex.from_segments(((iv['start'], iv['stop'], intern(iv['val'])) for iv in tree['intervals']),
+                                          sets)
+            for path, tree in js['used_lines'].items()
+        }
+
+        return cls(js['repo'], files, variants, {variant: js['commands'].get(variant) for variant in variants})
+
+    @classmethod
+    def load_binary(cls, path):
+        """Maps a `{commit}.lrdb` written by `mpc --storage-format binary`, the segments are searched in place"""
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, num_variants, num_files, num_segments, num_sets, num_words = HEADER.unpack_from(data)
+        if magic != b'LRDB' or version != VERSION:
+            raise ValueError(f'{path} is not an LRDB')
+        pos = HEADER.size
+
+        def read_bytes():
+            nonlocal pos
+            (length,) = U32.unpack_from(data, pos)
+            pos += U32.size + length
+            return data[pos - length:pos]
+
+        repo = os.fsdecode(read_bytes())
+
+        variants = []
+        commands = {}
+        for _ in range(num_variants):
+            variant = read_bytes().decode()
+            kind = data[pos]
+            pos += 1
+            commands[variant] = read_bytes().decode() if kind == 2 else None
+            variants.append(variant)
+
+        ranges = []
+        for _ in range(num_files):
+            path_name = os.fsdecode(read_bytes())
+            ranges.append((path_name, *FILE_RANGE.unpack_from(data, pos)))
+            pos += FILE_RANGE.size
+
+        pos += -pos % 8
+        words = struct.unpack_from(f'<{num_sets * num_words}Q', data, pos)
+        # storages without used lines have no words per set
+        sets = [words_to_int(words[i:i + num_words]) for i in range(0, len(words), num_words)] if num_words else []
+        pos += 8 * num_sets * num_words
+
+        columns = memoryview(data)[pos:pos + 3 * 4 * num_segments].cast('I')
+        if sys.byteorder != 'little':
+            columns = array('I', columns)
+            columns.byteswap()
+        starts = columns[:num_segments]
+        stops = columns[num_segments:2 * num_segments]
+        values = columns[2 * num_segments:]
+
+        files = {
+            path_name: FileIndex(starts[first:first + length], stops[first:first + length],
+                                 values[first:first + length], max_len, sets)
+            for path_name, first, length, max_len in ranges
+        }
+
+        return cls(repo, files, variants, commands)
+
+    @classmethod
+    def merge(cls, parts):
+        """Combines the databases of disjoint sets of variants, segments of different parts may overlap"""
+        variants = []
+        commands = {}
+        sets = []
+        ids = {}
+        segments = {}
+
+        for part in parts:
+            offset = len(variants)
+            variants += part.variants
+            commands.update(part.commands)
+
+            for path, index in part.files.items():
+                file_segments = segments.setdefault(path, [])
+                for start, stop, value in zip(index.starts, index.stops, index.values):
+                    used = index.sets[value] << offset
+                    if used not in ids:
+                        ids[used] = len(sets)
+                        sets.append(used)
+                    file_segments.append((start, stop, ids[used]))
+
+        files = {path: FileIndex.from_segments(file_segments, sets) for path, file_segments in segments.items()}
+        return cls(parts[0].repo, files, variants, commands)
+
+    @classmethod
+    def open(cls, storage, commit):
+        """Loads the database of commit in either format, including variants that are not compacted yet"""
+        parts = []
+        for extension in EXTENSIONS:
+            path = os.path.join(storage, f'{commit}.{extension}')
+            if os.path.exists(path):
+                parts.append(cls.load(path))
+                break
+
+        segment_dir = os.path.join(storage, f'{commit}.d')
+        if os.path.isdir(segment_dir):
+            parts += [
+                cls.load(os.path.join(segment_dir, entry))
+                for entry in sorted(os.listdir(segment_dir))
+                if entry.rsplit('.', 1)[-1] in EXTENSIONS
+            ]
+
+        if not parts:
+            raise FileNotFoundError(f'no LRDB for {commit} in {storage}')
+        return parts[0] if len(parts) == 1 else cls.merge(parts)
+
+    def variant_names(self, used):
+        return sorted(variant for i, variant in enumerate(self.variants) if used >> i & 1)
+
+    def affected(self, changes, alarm_list=None, filter_asm=False, changed_commands=()):
+        """Returns the affected variants and the changed files responsible for it, like `mpc --check-storage`
+
+        changes maps absolute paths to a list of changed [start, stop) line ranges, or None if the whole file changed.
+        changed_commands lists the variants whose compilation database changed, they are affected if it was recorded.
+        """
+        if filter_asm:
+            asm_changed = [path for path in changes if os.path.splitext(path)[1].lower() in ('.s', '.asm')]
+            if asm_changed:
+                return sorted(self.commands), sorted(asm_changed)
+
+        if alarm_list:
+            alarms = [os.path.join(self.repo, path) for path in alarm_list]
+            changed_alarms = [path for path in alarms if path in changes]
+            if changed_alarms:
+                return sorted(self.commands), sorted(changed_alarms)
+
+        affected = 0
+        for i, variant in enumerate(self.variants):
+            if variant in changed_commands and self.commands.get(variant) is not None:
+                affected |= 1 << i
+
+        files = []
+        for path, lines in changes.items():
+            index = self.files.get(path)
+            if index is None:
+                continue
+
+            if lines is None:
+                used = index.all()
+            else:
+                used = 0
+                for start, stop in lines:
+                    used |= index.find(start, stop)
+
+            if used:
+                affected |= used
+                files.append(path)
+
+        return self.variant_names(affected), sorted(files)
@@ -0,0 +1,63 @@
+import os
+import json
+import logging
+import subprocess
+
+from subprocess import DEVNULL
+
+
+class MpcDaemon:
+    """`mpc serve` process that answers `mpc analyze` requests
+
+    The process keeps the git repository, the loaded LRDBs and the compile commands hashes across requests.
+    Every request is answered by exactly one report, a crashed process is restarted by the next request.
+    """
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.process = None
+        self.reports = None
+
+    def __start(self):
+        read_fd, write_fd = os.pipe()
+        argv = [self.tool, 'serve', '--output', f'/dev/fd/{write_fd}']
+        logging.debug(argv)
+
+        output = None if logging.root.level <= logging.DEBUG else DEVNULL
+        self.process = subprocess.Popen(argv, pass_fds=(write_fd,), stdin=subprocess.PIPE, stdout=output,
+                                        stderr=output, text=True)
+        os.close(write_fd)
+        self.reports = os.fdopen(read_fd, 'r')
+
+    def request(self, argv):
+        """Runs `mpc analyze argv` and returns its report, argv must not contain --format or --output"""
+        if self.process is None or self.process.poll() is not None:
+            self.close()
+            self.__start()
+
+        logging.debug(argv)
+        try:
+            self.process.stdin.write(json.dumps({'argv': argv}) + '\n')
+            self.process.stdin.flush()
+            line = self.reports.readline()
+        except BrokenPipeError:
+            line = ''
+
+        if not line:
+            self.close()
+            return {'error': 'mpc serve exited', 'affected': None, 'files': [], 'timings': {}}
+        return json.loads(line)
+
+    def close(self):
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        logging.debug('RESULT: %d', self.process.returncode)
+        self.reports.close()
+        self.process = None
+        self.reports = None
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Compiler wrapper that reuses object files (and their o-info files) across variants and commits
+
+    SIB_OBJCACHE=/path/to/cache objcache.py clang-15 -c foo.c -o foo.o ...
+
+Entries are keyed by the preprocessed input and the compile command without the names of its outputs. Hits are
+hardlinked into place instead of compiling. Commands that do not compile a single C/C++ file with -c are passed
+through unchanged.
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.C')
+# flags that change what the compiler does beyond writing a single object file
+UNCACHEABLE_FLAGS = ('-E', '-S', '-M', '-MM', '-save-temps', '--analyze')
+# flags followed by the name of a dependency file output, they do not change the object
+DEPENDENCY_FLAGS = ('-MF', '-MT', '-MQ')
+# variables of the plugin that change the o-info files
+PLUGIN_VARIABLES = ('SIB_INFO_STORE', 'SIB_RECORD_ARGS')
+
+
+def parse(args):
+    """Returns the output, the preprocessor arguments and the normalized command, None if it is not cacheable"""
+    output = None
+    sources = []
+    compile_only = False
+    preprocess_args = []
+    key_args = []
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+
+        if arg in UNCACHEABLE_FLAGS or arg.startswith('@'):
+            return None
+        if arg == '-c':
+            compile_only = True
+            key_args.append(arg)
+        elif arg == '-o':
+            if i == len(args):
+                return None
+            output = args[i]
+            i += 1
+        elif arg.startswith('-o'):
+            output = arg[2:]
+        elif arg in DEPENDENCY_FLAGS:
+            if i == len(args):
+                return None
+            preprocess_args += [arg, args[i]]
+            i += 1
+        elif arg.startswith(DEPENDENCY_FLAGS) or arg in ('-MD', '-MMD') or arg.startswith(('-Wp,-MD,', '-Wp,-MMD,')):
+            preprocess_args.append(arg)
+        elif arg.startswith('-fplugin'):
+            # the preprocessor run must not write o-info files
+            key_args.append(arg)
+        elif not arg.startswith('-') and arg.endswith(SOURCE_EXTENSIONS):
+            sources.append(arg)
+            preprocess_args.append(arg)
+            key_args.append(arg)
+        else:
+            preprocess_args.append(arg)
+            key_args.append(arg)
+
+    if not compile_only or len(sources) != 1:
+        return None
+    if output is None:
+        output = os.path.splitext(os.path.basename(sources[0]))[0] + '.o'
+
+    # the dependency file has to name the same target and path as the one of the compiler
+    if '-MD' in preprocess_args or '-MMD' in preprocess_args:
+        if not any(arg.startswith('-MF') for arg in preprocess_args):
+            preprocess_args += ['-MF', os.path.splitext(output)[0] + '.d']
+        if not any(arg.startswith(('-MT', '-MQ')) for arg in preprocess_args):
+            preprocess_args += ['-MT', output]
+
+    return output, preprocess_args, key_args
+
+
+def get_key(compiler, preprocess_args, key_args):
+    """Hashes the preprocessed input together with the command, None if preprocessing fails"""
+    p = subprocess.run([compiler] + preprocess_args + ['-E', '-o', '-'], stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL)
+    if p.returncode != 0:
+        return None
+
+    h = hashlib.sha256()
+    for part in [compiler, os.getcwd()] + key_args + [f'{name}={os.environ.get(name)}' for name in PLUGIN_VARIABLES]:
+        h.update(part.encode())
+        h.update(b'\0')
+    h.update(p.stdout)
+    return h.hexdigest()
+
+
+def stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def link(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def fetch(entry, outputs):
+    """Links the cached outputs into place, False if the entry misses one or was modified after it was stored"""
+    try:
+        with open(entry + '.json', 'r') as f:
+            stamps = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    cached = {suffix: entry + suffix for suffix in outputs}
+    # hardlinked objects that the build modified in place (e.g. objtool) invalidate the entry
+    if set(stamps) != set(outputs) or any(
+            not os.path.exists(path) or stamp(path) != stamps[suffix] for suffix, path in cached.items()):
+        return False
+
+    for suffix, path in outputs.items():
+        link(cached[suffix], path)
+    return True
+
+
+def store(entry, outputs):
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    stamps = {}
+    for suffix, path in outputs.items():
+        # linked under a unique name first, so concurrent compilers never see a partial entry
+        tmp_path = f'{entry}{suffix}.{os.getpid()}'
+        link(path, tmp_path)
+        os.replace(tmp_path, entry + suffix)
+        stamps[suffix] = stamp(entry + suffix)
+
+    tmp_path = f'{entry}.json.{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(stamps, f)
+    os.replace(tmp_path, entry + '.json')
+
+
+def main():
+    compiler, args = sys.argv[1], sys.argv[2:]
+    cache_dir = os.environ.get('SIB_OBJCACHE')
+
+    parsed = parse(args) if cache_dir else None
+    key = get_key(compiler, parsed[1], parsed[2]) if parsed else None
+    if key is None:
+        os.execvp(compiler, [compiler] + args)
+
+    output = parsed[0]
+    outputs = {'.o': output}
+    if any(arg.startswith('-fplugin=') for arg in args):
+        outputs['.o-info'] = output + '-info'
+
+    entry = os.path.join(cache_dir, key[:2], key)
+    if fetch(entry, outputs):
+        return 0
+
+    p = subprocess.run([compiler] + args)
+    if p.returncode == 0 and all(os.path.exists(path) for path in outputs.values()):
+        store(entry, outputs)
+    return p.returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -154,6 +154,15 @@ class OpenSSLManager(ProjectManager):
         subprocess.run(argv, env=my_env, check=True, stdout=DEVNULL)
         self.__restore_config_fixes()
 
+    def get_config_inputs(self):
+        return [
+            'Configure',
+            'config',
+            'VERSION.dat',
+            'Configurations/',
+            ':(glob)**/build.info',
+        ]
+
     def build(self):
         rerun = False
         my_env = os.environ.copy()
@@ -22,7 +22,7 @@ class OpenSSLWOPManager(OpenSSLManager):
 
     # in this case we don't want to use multipatchcheck but implement a alternative approach
     def multipatchcheck(self, *args, **kwargs):
-        object_hashes = self.get_hashes()
+        object_hashes = self.hashes.result()
         with open('/tmp/tmphash', 'w') as file:
             json.dump(object_hashes, file)
 
@@ -2,21 +2,39 @@ import os
 import sys
 import json
 import time
+import fcntl
 import shutil
 import hashlib
+import tempfile
+import threading
 import logging
 import subprocess
 import importlib.util
 
 from subprocess import DEVNULL
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from hashstore import HashStore, diff_objects
+from lrdb import EXTENSIONS, LRDB
+from mpcdaemon import MpcDaemon
 
 
 class ProjectManager:
 
     ALARM_LIST = None
 
+    # files of the build system, the used lines of a variant do not tell whether their changes affect it
+    BUILD_FILES = [':(glob)**/Makefile*', ':(glob)**/configure*', ':(glob)**/*.mk', ':(glob)**/CMakeLists.txt']
+
+    # phases reported by span(), in the order of the optional CSV columns
+    PHASES = ['reset', 'clean', 'checkout', 'apply', 'config', 'build', 'hashing', 'compiledb', 'mpc_dump',
+              'mpc_check', 'hash_write', 'validate']
+
     def __init__(self, path, plugin, tool, compiler, dump_dir):
         self.path = path
+        # the checkout results are reported for, differs from path when building in a worktree
+        self.origin = path
         self.plugin = plugin
         self.jobs = str(os.cpu_count())
         self.tool = tool
@@ -25,6 +43,30 @@ class ProjectManager:
             self.compiler_pp = compiler.replace('clang', 'clang++')
         self.dump_dir = dump_dir
         self.variant = ""
+        # format of the LRDBs mpc dumps, 'json' or 'binary'
+        self.storage_format = 'json'
+        # let mpc find the o-info files through compile_commands.json instead of searching the tree
+        self.info_from_compile_commands = False
+        # let mpc diff every commit pair once instead of per check, see precompute_diffs()
+        self.diff_cache = False
+        # send the mpc analyses to one long-running `mpc serve` per process instead of spawning mpc each time
+        self.use_daemon = False
+        # answer the checks with lrdb.py from the LRDB and the diff cache instead of spawning mpc
+        self.check_in_process = False
+        # build only the variants mpc predicts to be affected since the previous commit, see carry_forward()
+        self.skip_unaffected = False
+        # how get_variants() picks the variants, 'random' or 'coverage'
+        self.sampler = 'random'
+        self.__daemon = None
+        self.__daemon_pid = None
+        self.__store = None
+        self.__check_results = {}
+        self.__predictions = {}
+        self.spans = {}
+        self.artifacts = []
+        # future of the object hashes of the current build, multipatchcheck() overrides wait for it instead of
+        # hashing again
+        self.hashes = None
 
     @staticmethod
     def load(path):
@@ -37,6 +79,56 @@ class ProjectManager:
 
         return module.MANAGER
 
+    @contextmanager
+    def span(self, phase):
+        """Adds the time spent in the with-block to phase"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans[phase] = self.spans.get(phase, 0) + time.monotonic() - start
+
+    def pop_spans(self):
+        spans, self.spans = self.spans, {}
+        return spans
+
+    def pop_artifacts(self):
+        artifacts, self.artifacts = self.artifacts, []
+        return artifacts
+
+    def failed(self, message):
+        """Returns the row of a run that failed, the journal marks it so that --resume runs it again"""
+        self.artifacts.append(('failed',))
+        return [message]
+
+    def has_artifacts(self, artifacts):
+        """Checks that an earlier run succeeded and the outputs it recorded still exist"""
+        for kind, *key in artifacts:
+            if kind == 'failed':
+                return False
+            if kind == 'file' and not os.path.exists(key[0]):
+                return False
+            if kind == 'hashes' and not self.store.contains(*key):
+                return False
+            if kind == 'lrdb' and not self.__has_lrdb(*key):
+                return False
+        return True
+
+    def __has_lrdb(self, commit, variant):
+        info_dir = os.path.join(self.dump_dir, 'info')
+        # a compacted database contains all variants dumped before
+        return any(
+            os.path.exists(os.path.join(info_dir, path))
+            for extension in EXTENSIONS
+            for path in (f'{commit}.{extension}', f'{commit}.d/{variant}.{extension}'))
+
+    @property
+    def store(self):
+        # sqlite connections must not be shared with forked workers
+        if not self.__store or self.__store[0] != os.getpid():
+            self.__store = (os.getpid(), HashStore(os.path.join(self.dump_dir, 'hashes.db')))
+        return self.__store[1]
+
     def get_variant_id(self):
         return hashlib.blake2b(" ".join(self.variant).encode('utf-8')).hexdigest()[:8]
 
@@ -54,20 +146,160 @@ class ProjectManager:
                 ret += [f'{variant}:{os.path.join(root, file)}']
         return ret
 
-    def multipatchcheck(self, commit, variant_aware=False, check=False, change_commit=None):
+    def to_origin(self, path):
+        if self.path == self.origin:
+            return path
+        return os.path.join(self.origin, os.path.relpath(path, self.path))
+
+    def __analyze_argv(self, commit, variant_aware=False, check=False, change_commit=None):
         info_dir = os.path.join(self.dump_dir, 'info')
 
         argv = [self.tool, 'analyze', '--filter-asm', self.path]
         if variant_aware:
             var_id = self.get_variant_id()
             argv += ['--commit', commit, '--variant', var_id, '--storage', info_dir, '--compile-commands', '--dump-only']
+            if self.path != self.origin:
+                argv += ['--rebase-dir', self.origin]
+            if self.storage_format != 'json':
+                argv += ['--storage-format', self.storage_format]
+            if self.info_from_compile_commands:
+                argv += ['--info-from-compile-commands']
 
         if check:
             argv += ['--commit', commit, '--storage', info_dir, '--check-storage']
             argv += ['--compile-commands-path-map'] + self.__get_current_compiledbs(change_commit)
             if self.ALARM_LIST:
                 argv += ['--compare-git'] + self.ALARM_LIST
+            if self.diff_cache:
+                argv += ['--diff-cache', self.__diff_dir(), '--change', change_commit]
+
+        return argv
+
+    def __diff_dir(self):
+        return os.path.join(self.dump_dir, 'diffs')
+
+    def precompute_diffs(self, commit_pairs):
+        """Lets mpc compute the changes of all (base, change) pairs in parallel, the checks then read them"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pairs_path = os.path.join(tmp_dir, 'pairs.json')
+            with open(pairs_path, 'w') as f:
+                json.dump([{'commit': base, 'change': change} for base, change in commit_pairs], f)
+
+            p = self.__run_tool([self.tool, 'diff', '--pairs', pairs_path, '--output', self.__diff_dir(), self.path])
+        if p.returncode != 0:
+            logging.error('Computing the diffs failed, the checks compute them instead')
+
+    def multipatchcheck(self, commit, variant_aware=False, check=False, change_commit=None):
+        info_dir = os.path.join(self.dump_dir, 'info')
+        argv = self.__analyze_argv(commit, variant_aware, check, change_commit)
+
+        with self.__storage_lock(info_dir, exclusive=False):
+            if self.use_daemon:
+                return self.__run_daemon(argv)
+            return self.__run_tool(argv)
+
+    def compact(self, commit):
+        """Merges the LRDBs dumped per variant of commit into one"""
+        info_dir = os.path.join(self.dump_dir, 'info')
+        if not os.path.isdir(os.path.join(info_dir, f'{commit}.d')):
+            return
 
+        argv = [self.tool, 'analyze', '--commit', commit, '--storage', info_dir, '--compact', self.path]
+        if self.storage_format != 'json':
+            argv += ['--storage-format', self.storage_format]
+
+        with self.span('compact'), self.__storage_lock(info_dir, exclusive=True):
+            p = self.__run_daemon(argv) if self.use_daemon else self.__run_tool(argv)
+        if p.returncode != 0:
+            logging.error('Compacting the LRDB of %s failed', commit)
+
+    def check(self, base_commit, change_commit):
+        """Returns the report of mpc for change_commit, None if mpc failed"""
+        if self.check_in_process:
+            report = self.__check_in_process(base_commit, change_commit)
+            if report is not None:
+                return report
+
+        info_dir = os.path.join(self.dump_dir, 'info')
+        argv = self.__analyze_argv(base_commit, check=True, change_commit=change_commit)
+
+        with self.__storage_lock(info_dir, exclusive=False):
+            if self.use_daemon:
+                report = self.__get_daemon().request(argv[2:])
+                return None if report['error'] else report
+            reports = list(self.__stream_tool(argv))
+
+        return reports[0] if reports else None
+
+    def __compiledb_changed(self, base_commit, change_commit, variant):
+        """Compares the compilation databases of variant like mpc compares their hashes"""
+        commands = []
+        for commit in [base_commit, change_commit]:
+            path = os.path.join(self.dump_dir, f'{commit}-{variant}-compile_commands.json')
+            if not os.path.exists(path):
+                return False
+            with open(path, 'r') as f:
+                commands.append(sorted(json.dumps(command, sort_keys=True) for command in json.load(f)))
+        return commands[0] != commands[1]
+
+    def __check_in_process(self, base_commit, change_commit):
+        """Returns a report like check() from the diff cache entry of the pair, None if there is none"""
+        timings = {}
+        start = time.monotonic()
+        path = os.path.join(self.__diff_dir(), f'{base_commit}..{change_commit}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            entry = json.load(f)
+        timings['git'] = time.monotonic() - start
+
+        info_dir = os.path.join(self.dump_dir, 'info')
+        start = time.monotonic()
+        try:
+            with self.__storage_lock(info_dir, exclusive=False):
+                lrdb = LRDB.open(info_dir, base_commit)
+        except FileNotFoundError as e:
+            logging.debug(e)
+            return None
+        timings['lrdb'] = time.monotonic() - start
+
+        start = time.monotonic()
+        changes = {os.path.join(lrdb.repo, file): lines for file, lines in entry['files'].items()}
+        changed_commands = [variant for variant in lrdb.commands
+                            if self.__compiledb_changed(base_commit, change_commit, variant)]
+        affected, files = lrdb.affected(changes, self.ALARM_LIST, filter_asm=True, changed_commands=changed_commands)
+        timings['lookup'] = time.monotonic() - start
+
+        return {'affected': affected, 'files': files, 'timings': timings}
+
+    @staticmethod
+    def __storage_lock(info_dir, exclusive):
+        # variants are dumped side by side, only compacting them into {commit}.json needs exclusive access
+        lock = open(os.path.join(info_dir, '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock
+
+    def __get_daemon(self):
+        # forked workers start their own daemon instead of sharing the pipes of their parent
+        if self.__daemon is None or self.__daemon_pid != os.getpid():
+            self.__daemon = MpcDaemon(self.tool)
+            self.__daemon_pid = os.getpid()
+        return self.__daemon
+
+    def __run_daemon(self, argv):
+        """Runs the mpc analyze argv in the daemon, the result looks like the one of __run_tool"""
+        report = self.__get_daemon().request(argv[2:])
+        if report['error']:
+            logging.debug(report['error'])
+        return subprocess.CompletedProcess(argv, 1 if report['error'] else 0, '', report['error'] or '')
+
+    def close_daemon(self):
+        if self.__daemon is not None and self.__daemon_pid == os.getpid():
+            self.__daemon.close()
+        self.__daemon = None
+
+    @staticmethod
+    def __run_tool(argv):
         if logging.root.level < logging.DEBUG:
             p = subprocess.run(argv,
                                check=False,
@@ -83,44 +315,297 @@ class ProjectManager:
             logging.debug(p.stderr)
         return p
 
+    @staticmethod
+    def __stream_tool(argv):
+        """Runs mpc with JSON output and yields its reports as soon as they are written"""
+        read_fd, write_fd = os.pipe()
+        argv = argv + ['--format', 'json', '--output', f'/dev/fd/{write_fd}']
+        logging.debug(argv)
+
+        # logs are passed through instead of being buffered
+        output = None if logging.root.level <= logging.DEBUG else DEVNULL
+        p = subprocess.Popen(argv, pass_fds=(write_fd,), stdout=output, stderr=output)
+        os.close(write_fd)
+
+        try:
+            with os.fdopen(read_fd, 'r') as reports:
+                for line in reports:
+                    yield json.loads(line)
+        finally:
+            p.wait()
+            logging.debug('RESULT: %d', p.returncode)
+
+    def __check_pairs(self, commit_pairs, compiledbs=True):
+        """Checks all (base, change) pairs with a single mpc process and yields their reports
+
+        Without compiledbs, the compile commands of the change commits are not compared.
+        """
+        info_dir = os.path.join(self.dump_dir, 'info')
+
+        requests = [{
+            'commit': base_commit,
+            'change': change_commit,
+            'compile_commands_path_map': self.__get_current_compiledbs(change_commit) if compiledbs else None,
+        } for base_commit, change_commit in commit_pairs]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            requests_path = os.path.join(tmp_dir, 'requests.json')
+            with open(requests_path, 'w') as f:
+                json.dump(requests, f)
+
+            # the changes are read from the commits, so the checkout the variant is built in does not matter
+            argv = [self.tool, 'analyze', '--filter-asm', self.origin, '--storage', info_dir, '--check-storage',
+                    '--check-batch', requests_path]
+            if self.ALARM_LIST:
+                argv += ['--compare-git'] + self.ALARM_LIST
+            if self.diff_cache:
+                argv += ['--diff-cache', self.__diff_dir()]
+
+            with self.__storage_lock(info_dir, exclusive=False):
+                yield from self.__stream_tool(argv)
+
+    def check_batch(self, commit_pairs):
+        """Checks all (base, change) pairs with a single mpc process, run_check picks up the results"""
+        for report in self.__check_pairs(commit_pairs):
+            if report['error']:
+                logging.debug('%s: %s', report['change'], report['error'])
+                continue
+            self.__check_results[report['change']] = report
+
+    def __predict_affected(self, base_commit, change_commit):
+        """Variants mpc predicts change_commit to affect, None if it cannot tell"""
+        key = (base_commit, change_commit)
+        if key in self.__predictions:
+            return self.__predictions[key]
+
+        # change_commit is not built yet, so its compile commands cannot be compared: any change of the build
+        # system may change them
+        inputs = self.BUILD_FILES + self.__tracked_config_inputs()
+        if subprocess.run(['git', 'diff', '--quiet', base_commit, change_commit, '--'] + inputs,
+                          cwd=self.origin).returncode != 0:
+            logging.info('Build system of %s changed, building all variants', change_commit)
+            affected = None
+        else:
+            reports = list(self.__check_pairs([key], compiledbs=False))
+            if not reports or reports[0]['error']:
+                logging.warning('Predicting %s failed, building all variants', change_commit)
+                affected = None
+            else:
+                affected = reports[0]['affected']
+
+        self.__predictions[key] = affected
+        return affected
+
+    def carry_forward(self, previous_commit, commit):
+        """Reuses the LRDB entries and object hashes of the variant at previous_commit for commit
+
+        Returns the results of run() without building, None if mpc predicts commit to affect the variant or the
+        build of previous_commit is missing.
+        """
+        variant_id = self.get_variant_id()
+        compiledb = os.path.join(self.dump_dir, f'{previous_commit}-{variant_id}-compile_commands.json')
+        if not (self.__has_lrdb(previous_commit, variant_id) and os.path.exists(compiledb)
+                and self.__get_objects(previous_commit, variant_id) is not None):
+            return None
+
+        # configuration files outside the repository may have changed since previous_commit was built
+        external = self.__external_config_stamp()
+        config_stamp = self.__config_stamp_path(previous_commit, variant_id)
+        if external:
+            if not os.path.exists(config_stamp):
+                return None
+            with open(config_stamp, 'r') as f:
+                if f.read() != external:
+                    logging.debug('Configuration of %s changed since %s', variant_id, previous_commit)
+                    return None
+
+        start = time.monotonic()
+        with self.span('mpc_check'):
+            affected = self.__predict_affected(previous_commit, commit)
+        if affected is None or variant_id in affected:
+            return None
+
+        info_dir = os.path.join(self.dump_dir, 'info')
+        argv = [self.tool, 'carry', '--storage', info_dir, '--commit', previous_commit, '--change', commit,
+                '--variant', variant_id, self.origin]
+        if self.storage_format != 'json':
+            argv += ['--storage-format', self.storage_format]
+        with self.span('mpc_dump'), self.__storage_lock(info_dir, exclusive=False):
+            p = self.__run_tool(argv)
+        end = time.monotonic()
+        if p.returncode != 0:
+            logging.warning('Carrying %s forward to %s failed, building it', variant_id, commit)
+            return None
+        self.artifacts.append(('lrdb', commit, variant_id))
+
+        path = os.path.join(self.dump_dir, f'{commit}-{variant_id}-compile_commands.json')
+        shutil.copy2(compiledb, path)
+        self.artifacts.append(('file', path))
+        if external:
+            shutil.copy2(config_stamp, self.__config_stamp_path(commit, variant_id))
+
+        with self.span('hash_write'):
+            self.store.copy(previous_commit, variant_id, commit)
+        self.artifacts.append(('hashes', commit, variant_id))
+
+        return [0, 0, end - start, '', 1]
+
     @staticmethod
     def __hash_file(path: str):
+        # reads in chunks, hashlib releases the GIL while hashing
         with open(path, 'rb') as f:
-            return hashlib.blake2b(f.read()).hexdigest()
+            return hashlib.file_digest(f, hashlib.blake2b).hexdigest()
 
     def get_ignore_patterns(self):
         return []
 
+    def __list_objects(self):
+        ignore_patterns = tuple(self.get_ignore_patterns())
+
+        for root, dirs, files in os.walk(self.path):
+            # never descend into ignored subtrees
+            dirs[:] = [d for d in dirs if not os.path.join(root, d, '').startswith(ignore_patterns)]
+
+            for file in files:
+                if not file.endswith('.o') or file.endswith('.mod.o'):
+                    continue
+
+                path = os.path.join(root, file)
+                if not path.startswith(ignore_patterns):
+                    yield path
+
+    def __hash_cache_path(self):
+        if not self.dump_dir:
+            return None
+
+        # every worktree has its own objects
+        workspace = hashlib.blake2b(self.path.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.dump_dir, f'hash-cache-{workspace}.json')
+
+    @staticmethod
+    def __load_hash_cache(path):
+        if not path or not os.path.exists(path):
+            return {}
+
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning('Ignoring corrupt hash cache %s', path)
+            return {}
+
+    @staticmethod
+    def __store_hash_cache(path, cache):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+
     def get_hashes(self):
-        ignore_patterns = self.get_ignore_patterns()
-
-        def matches_ignored(s):
-            for p in ignore_patterns:
-                if s.startswith(p):
-                    return True
-            return False
-
-        object_hashes = {}
-        for root, _, files in os.walk(self.path):
-            object_hashes.update(
-                map(
-                    lambda f: (f, ProjectManager.__hash_file(f)),
-                    filter(
-                        lambda f: not matches_ignored(f),
-                        map(
-                            lambda f: os.path.join(root, f),
-                            filter(
-                                lambda f: f.endswith('.o') and not f.endswith(
-                                    '.mod.o'), files)))))
+        cache_path = self.__hash_cache_path()
+        cache = self.__load_hash_cache(cache_path)
+
+        # only objects that were rewritten since the last build are hashed again
+        objects = {}
+        stale = []
+        for path in self.__list_objects():
+            stat = os.stat(path)
+            key = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+            objects[path] = key
+
+            cached = cache.get(path)
+            if not cached or cached[:3] != key:
+                stale.append(path)
+
+        logging.debug('Hashing %d of %d objects', len(stale), len(objects))
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            new_hashes = dict(zip(stale, executor.map(ProjectManager.__hash_file, stale)))
+
+        object_hashes = {path: new_hashes[path] if path in new_hashes else cache[path][3] for path in objects}
+
+        # entries of objects that no longer exist are dropped
+        if cache_path:
+            self.__store_hash_cache(cache_path,
+                                    {path: key + [object_hashes[path]] for path, key in objects.items()})
 
         return object_hashes
 
+    def __get_hashes_timed(self):
+        with self.span('hashing'):
+            return self.get_hashes()
+
+    def get_hashes_async(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self.__get_hashes_timed)
+        executor.shutdown(wait=False)
+        return future
+
+    def get_config_inputs(self):
+        """Pathspecs of the tracked files the configuration reads, absolute paths for files outside the repository"""
+        return []
+
+    def __tracked_config_inputs(self):
+        return [path for path in self.get_config_inputs() if not os.path.isabs(path)]
+
+    def __external_config_stamp(self):
+        """Hashes the contents of the configuration inputs outside the repository, None if there are none"""
+        paths = [path for path in self.get_config_inputs() if os.path.isabs(path)]
+        if not paths:
+            return None
+
+        stamp = hashlib.blake2b()
+        for path in paths:
+            stamp.update(path.encode('utf-8'))
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    stamp.update(hashlib.file_digest(f, hashlib.blake2b).digest())
+        return stamp.hexdigest()
+
+    def __config_stamp_path(self, commit, variant_id):
+        return os.path.join(self.dump_dir, f'{commit}-{variant_id}-config.stamp')
+
+    def get_config_stamp(self):
+        stamp = hashlib.blake2b()
+        stamp.update(" ".join(self.variant).encode('utf-8'))
+        stamp.update(f'{self.compiler}:{self.plugin}'.encode('utf-8'))
+
+        inputs = self.__tracked_config_inputs()
+        if inputs:
+            p = subprocess.run(['git', 'ls-files', '--stage', '--'] + inputs,
+                               check=True,
+                               capture_output=True)
+            stamp.update(p.stdout)
+
+        external = self.__external_config_stamp()
+        if external:
+            stamp.update(external.encode('utf-8'))
+
+        return stamp.hexdigest()
+
     def config(self):
         raise NotImplementedError()
 
     def build(self):
         raise NotImplementedError()
 
+    def timed_build(self):
+        """Builds and returns the result of build(), its duration and the CPU seconds the plugin reported"""
+        plugin_times = os.path.join(self.dump_dir, f'plugin-times-{os.getpid()}')
+        open(plugin_times, 'w').close()
+        os.environ['SIB_PLUGIN_TIMES'] = plugin_times
+        try:
+            start = time.monotonic()
+            with self.span('build'):
+                p = self.build()
+            end = time.monotonic()
+        finally:
+            del os.environ['SIB_PLUGIN_TIMES']
+
+        with open(plugin_times, 'r') as f:
+            plugin_t = sum(float(line) for line in f if line.strip())
+        os.remove(plugin_times)
+        return p, end - start, plugin_t
+
     def clean(self):
         subprocess.run(['make', 'clean'],
                        check=True,
@@ -149,110 +634,215 @@ class ProjectManager:
 
         return [[]] + list(sorted(map(list, var_set)))
 
-    def __diff_objects(base_objects, change_objects):
-        equal = True
-        for file, base_hash in base_objects.items():
-            new_hash = change_objects.get(file)
-            if not new_hash:
-                equal = False
-                logging.debug('file removed: %s', file)
-            elif base_hash != new_hash:
-                equal = False
-                logging.debug('file changed: %s', file)
-
-        new_files = base_objects.keys() - change_objects.keys()
-        if new_files:
-            logging.debug('files added: %s', new_files)
-            equal = False
-
-        return equal
-
-    def __get_untracked_compiler_input(self, path):
+    def get_variants(self, count):
+        if self.sampler == 'coverage':
+            return self.get_coverage_variants(count)
+        return self.get_random_variants(count)
+
+    def __variants_path(self):
+        return os.path.join(self.dump_dir, 'variants.json')
+
+    def record_variants(self, var_table):
+        """Remembers the flags of every variant id, so later runs can relate LRDBs to flags"""
+        path = self.__variants_path()
+        known = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                known = json.load(f)
+        known.update(var_table)
+
+        with open(path + '.tmp', 'w') as f:
+            json.dump(known, f)
+        os.replace(path + '.tmp', path)
+
+    def __load_coverage(self):
+        """The newest LRDB of an earlier run and the flags of its variants, (None, {}) without one"""
+        if not self.dump_dir or not os.path.exists(self.__variants_path()):
+            return None, {}
+        with open(self.__variants_path(), 'r') as f:
+            known = json.load(f)
+
+        info_dir = os.path.join(self.dump_dir, 'info')
+        commits = {}
+        for entry in os.scandir(info_dir) if os.path.isdir(info_dir) else []:
+            commit, extension = os.path.splitext(entry.name)
+            if extension[1:] in EXTENSIONS + ['d']:
+                commits[commit] = max(commits.get(commit, 0), entry.stat().st_mtime)
+        if not commits:
+            return None, {}
+
+        commit = max(commits, key=commits.get)
+        logging.info('Sampling variants by the coverage of %s', commit)
+        return LRDB.open(info_dir, commit), known
+
+    def get_coverage_variants(self, count):
+        """Picks variants that greedily add the most distinct features to the ones picked before
+
+        Candidates come from get_random_variant(), so they satisfy the constraints of the project. The features
+        of a candidate are the used lines of an earlier LRDB it is expected to use and, as tiebreaker and
+        stand-in without an LRDB, the settings of every pair of flags. A candidate is expected to use a segment
+        if it has one of the flag settings that all variants using the segment share and no other variant has.
+        """
+        candidates = {(): []}
+        for _ in range(max(100, 20 * count)):
+            variant = self.get_random_variant()
+            candidates.setdefault(tuple(sorted(variant)), variant)
+        flags = sorted({flag for variant in candidates.values() for flag in variant})
+
+        def settings(variant):
+            return frozenset((flag, flag in variant) for flag in flags)
+
+        # lines per set of flag settings that may each explain why a variant uses them
+        lines = {}
+        lrdb, known = self.__load_coverage()
+        if lrdb:
+            built = [settings(set(known[variant])) if variant in known else None for variant in lrdb.variants]
+            all_built = sum(1 << i for i, setting in enumerate(built) if setting is not None)
+            explained = {}
+            for index in lrdb.files.values():
+                for start, stop, value in zip(index.starts, index.stops, index.values):
+                    used = index.sets[value] & all_built
+                    # segments of every variant tell nothing about the flags
+                    if not used or used == all_built:
+                        continue
+                    if used not in explained:
+                        # settings all variants using the segment share and no other variant has
+                        unused = all_built & ~used
+                        using = [setting for i, setting in enumerate(built) if used >> i & 1]
+                        others = [setting for i, setting in enumerate(built) if unused >> i & 1]
+                        explained[used] = frozenset.intersection(*using).difference(*others)
+                    lines[explained[used]] = lines.get(explained[used], 0) + stop - start
+            lines.pop(frozenset(), None)
+
+        def features(variant):
+            enabled = set(variant)
+            pairs = {(a, a in enabled, b, b in enabled) for i, a in enumerate(flags) for b in flags[i + 1:]}
+            setting = settings(enabled)
+            return {explanation for explanation in lines if explanation & setting}, pairs
+
+        variants = [[]]
+        covered_lines, covered_pairs = features([])
+        del candidates[()]
+        candidates = [(variant, *features(variant)) for variant in candidates.values()]
+
+        while len(variants) < count and candidates:
+            best = max(range(len(candidates)), key=lambda i: (
+                sum(lines[explanation] for explanation in candidates[i][1] - covered_lines),
+                len(candidates[i][2] - covered_pairs)))
+            variant, variant_lines, pairs = candidates.pop(best)
+            variants.append(variant)
+            covered_lines |= variant_lines
+            covered_pairs |= pairs
+
+        if len(variants) < count:
+            logging.warning('Only %d distinct variants, sampled fewer than %d', len(variants), count)
+        return variants
+
+    def __log_diff(self, variant, diff):
+        if logging.root.level > logging.DEBUG:
+            return
+
+        for kind in ['added', 'removed', 'changed']:
+            paths = getattr(diff, kind)
+            if paths:
+                logging.debug('%s: files %s: %s', variant, kind, self.store.path_names(paths))
+
+    def __get_untracked_compiler_input(self, git, path):
         with open(path, 'r') as f:
             uses = json.load(f)
 
         compiled_files = set(uses['used_lines'].keys())
 
-        p = subprocess.run(['git', 'ls-files'], check=True, text=True, capture_output=True)
-
-        tracked_files = p.stdout.splitlines()
-        tracked_files = set(map(lambda f: os.path.join(self.path, f), tracked_files))
+        tracked_files = git.ls_files()
+        tracked_files = set(map(lambda f: os.path.join(self.origin, f), tracked_files))
 
         return sorted(compiled_files - tracked_files)
 
     def header(self):
-        return ['build_t', 'predict_t', 'untracked']
+        header = ['build_t', 'plugin_t', 'predict_t', 'untracked']
+        return header + ['build_avoided'] if self.skip_unaffected else header
 
     def header_ggt(self):
         return ['build_t']
 
     def header_check(self):
-        return ['check_t', 'affected', 'gt_equal', 'gt_changed', 'gt_build_fail', 'notes']
+        return ['check_t', 'affected', 'gt_equal', 'gt_changed', 'gt_build_fail', 'notes'] + \
+            ['gt_added', 'gt_removed', 'gt_modified', 'git_t', 'lrdb_t', 'lookup_t']
 
     def header_check_wop(self):
-        return ['check_t', 'equal', 'changed', 'build_fail', 'notes']
+        return ['check_t', 'equal', 'changed', 'build_fail', 'notes'] + ['added', 'removed', 'modified']
 
     def generate_ground_truth(self, git, base_commit, change_commit, variant_idx):
         results = []
 
         try:
             start = time.monotonic()
-            self.build()
+            with self.span('build'):
+                self.build()
             end = time.monotonic()
         except Exception as e:
             logging.error(e)
-            return [f'build of {base_commit} failed']
+            return self.failed(f'build of {base_commit} failed')
         results += [end - start]
 
         return results
 
-    def run_check_per_variant(self, git, base_commit, change_commit, variant_idx):
-        results = []
-
-        # apply changes
-        git.apply(change_commit)
-
-        # check for problematic changes
-        git_diff = subprocess.run(['git', 'diff', '--stat'],
-                                  check=True,
-                                  text=True,
-                                  capture_output=True)
+    def __get_notes(self, git, base_commit, change_commit):
+        """Classifies the changes of change_commit, using the changed paths of the diff cache if it has them"""
+        changes = None
+        if self.diff_cache:
+            path = os.path.join(self.__diff_dir(), f'{base_commit}..{change_commit}.json')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    changes = '\n'.join(json.load(f)['paths'])
+        if changes is None:
+            changes = git.diff_stat()
 
         notes = []
-        if 'Makefile' in git_diff.stdout:
+        if 'Makefile' in changes:
             notes += ['Makefile']
 
-        if 'configure' in git_diff.stdout:
+        if 'configure' in changes:
             notes += ['Configure']
 
-        if 'tools/' in git_diff.stdout or 'tool/' in git_diff.stdout:
+        if 'tools/' in changes or 'tool/' in changes:
             notes += ['tools']
 
-        if '.s' in git_diff.stdout.lower() or '.asm' in git_diff.stdout.lower():
+        if '.s' in changes.lower() or '.asm' in changes.lower():
             notes += ['asm']
 
+        return notes
+
+    def run_check_per_variant(self, git, base_commit, change_commit, variant_idx):
+        results = []
+
+        # apply changes
+        with self.span('apply'):
+            git.apply(change_commit)
+
+        # check for problematic changes
+        notes = self.__get_notes(git, base_commit, change_commit)
+
         variant = self.get_variant_id()
         fail_variant = ""
 
         start = time.monotonic()
-        base_path = os.path.join(self.dump_dir, f'{base_commit}-{self.get_variant_id()}-hashes.json')
-        change_path = os.path.join(self.dump_dir, f'{change_commit}-{self.get_variant_id()}-hashes.json')
-
-        if os.path.exists(base_path) and os.path.exists(change_path):
-            with open(base_path, 'r') as f:
-                base_objects = json.load(f)
-            with open(change_path, 'r') as f:
-                change_objects = json.load(f)
-            equal = ProjectManager.__diff_objects(base_objects, change_objects)
+        with self.span('validate'):
+            base_objects = self.__get_objects(base_commit, variant)
+            change_objects = self.__get_objects(change_commit, variant)
+
+        if base_objects is not None and change_objects is not None:
+            diff = diff_objects(base_objects, change_objects)
             end = time.monotonic()
             results += [end - start]
+            self.__log_diff(variant, diff)
         else:
             results += [0]
             fail_variant = variant
             print(f'failed {base_commit} {variant}')
 
-        equal_variant = variant if not fail_variant and equal else ""
-        changed_variant = variant if not fail_variant and not equal else ""
+        equal_variant = variant if not fail_variant and diff.equal else ""
+        changed_variant = variant if not fail_variant and not diff.equal else ""
 
         results += [equal_variant]
         results += [changed_variant]
@@ -260,64 +850,56 @@ class ProjectManager:
 
         results += [('|').join(notes)]
 
+        results += diff.counts()[:3] if not fail_variant else ['', '', '']
+
         return results
 
     def run_check(self, git, base_commit, change_commit, variant_idx):
         results = []
 
         # apply changes
-        git.apply(change_commit)
+        with self.span('apply'):
+            git.apply(change_commit)
 
         # check for problematic changes
-        git_diff = subprocess.run(['git', 'diff', '--stat'],
-                                  check=True,
-                                  text=True,
-                                  capture_output=True)
+        notes = self.__get_notes(git, base_commit, change_commit)
 
-        notes = []
-        if 'Makefile' in git_diff.stdout:
-            notes += ['Makefile']
-
-        if 'configure' in git_diff.stdout:
-            notes += ['Configure']
-
-        if 'tools/' in git_diff.stdout or 'tool/' in git_diff.stdout:
-            notes += ['tools']
-
-        if '.s' in git_diff.stdout.lower() or '.asm' in git_diff.stdout.lower():
-            notes += ['asm']
-
-        start = time.monotonic()
-        p = self.multipatchcheck(base_commit, check=True, change_commit=change_commit)
-        end = time.monotonic()
-        results += [end - start]
+        if change_commit in self.__check_results:
+            report = self.__check_results.pop(change_commit)
+            results += [sum(report['timings'].values())]
+        else:
+            start = time.monotonic()
+            with self.span('mpc_check'):
+                report = self.check(base_commit, change_commit)
+            end = time.monotonic()
+            results += [end - start]
 
-        affected_variants = []
-        for line in p.stdout.split('\n'):
-            logging.debug(line)
-            if 'affected' in line:
-                affected_variants = line.split('[mpc] ', 1)[1].removesuffix(' affected')
-                affected_variants = list(set(eval(affected_variants)))  # remove duplicates
-                affected_variants.sort()
-                break
+        report = report or {}
+        affected_variants = report.get('affected') or []
+        timings = report.get('timings', {})
 
         results += ["|".join(affected_variants)]
 
         # validation
-        base_variants = self.__get_objects_by_variant(base_commit)
-        change_variants = self.__get_objects_by_variant(change_commit)
+        with self.span('validate'):
+            diffs = self.__diff_commits(base_commit, change_commit)
 
         equal_variants = []
         changed_variants = []
         fail_variants = []
+        counts = [0, 0, 0]
 
-        if not base_variants:
-            return [f'build of {base_commit} failed']
+        if not diffs:
+            return self.failed(f'build of {base_commit} failed')
 
-        for variant, base_objects in base_variants.items():
-            if variant not in change_variants:
+        for variant, diff in diffs.items():
+            if diff is None:
                 fail_variants.append(variant)
-            elif ProjectManager.__diff_objects(base_objects, change_variants[variant]):
+                continue
+
+            self.__log_diff(variant, diff)
+            counts = [a + b for a, b in zip(counts, diff.counts())]
+            if diff.equal:
                 equal_variants.append(variant)
             else:
                 changed_variants.append(variant)
@@ -332,68 +914,83 @@ class ProjectManager:
 
         results += [('|').join(notes)]
 
+        results += counts
+
+        results += [timings.get(phase, 0) for phase in ['git', 'lrdb', 'lookup']]
+
         return results
 
-    def __get_objects_by_variant(self, commit):
-        entries = filter(lambda f: f.endswith('-hashes.json'), os.listdir(self.dump_dir))
-        entries = filter(lambda f: f.startswith(commit), entries)
-        entries = map(lambda f: os.path.join(self.dump_dir, f), entries)
+    def __get_objects(self, commit, variant):
+        if not self.store.contains(commit, variant):
+            # dump directories of earlier runs
+            self.store.import_json(self.dump_dir, commit)
+        return self.store.get(commit, variant)
 
-        objects_by_variant = {}
-        for entry in entries:
-            _, variant, _ = entry.split('-')
-            with open(entry, 'r') as f:
-                objects_by_variant[variant] = json.load(f)
+    def __diff_commits(self, base_commit, change_commit):
+        for commit in [base_commit, change_commit]:
+            if not self.store.get_commit(commit):
+                self.store.import_json(self.dump_dir, commit)
 
-        return objects_by_variant
+        return self.store.diff(base_commit, change_commit)
 
     def run(self, git, base_commit, change_commit, variant_idx):
         results = []
 
         # make -jn
         try:
-            start = time.monotonic()
-            p = self.build()
-            end = time.monotonic()
+            p, build_t, plugin_t = self.timed_build()
         except Exception as e:
             logging.error(e)
-            return [f'build of {base_commit} failed']
-        results += [end - start]
+            return self.failed(f'build of {base_commit} failed')
+        results += [build_t, plugin_t]
 
-        base_objects = self.get_hashes()
+        # hash objects while the compilation database and the LRDB are generated
+        self.hashes = self.get_hashes_async()
 
         try:
-            self.compile_commands(p.stdout.encode() if p else None)
+            with self.span('compiledb'):
+                self.compile_commands(p.stdout.encode() if p else None)
         except Exception as e:
             logging.error(e)
-            return [f'compile commands of {base_commit} failed']
+            wait([self.hashes])
+            return self.failed(f'compile commands of {base_commit} failed')
 
         # rebuild required?
         start = time.monotonic()
-        p = self.multipatchcheck(base_commit, variant_aware=True)
+        with self.span('mpc_dump'):
+            p = self.multipatchcheck(base_commit, variant_aware=True)
         end = time.monotonic()
         results += [end - start]
         if p:
             logging.debug('RESULT: %d', p.returncode)
             assert p.returncode == 0, p.stderr
-
         variant_id = self.get_variant_id()
+        # managers without plugin replace multipatchcheck and dump no LRDB
+        if p:
+            self.artifacts.append(('lrdb', base_commit, variant_id))
+        base_objects = {self.to_origin(f): h for f, h in self.hashes.result().items()}
 
         path = os.path.join(self.dump_dir, f'info/{base_commit}-{variant_id}.json')
         if os.path.exists(path):
             # only relevant when using mvpc
-            results += [f'"{self.__get_untracked_compiler_input(path)}"']
+            results += [f'"{self.__get_untracked_compiler_input(git, path)}"']
         else:
-            results += []
+            results += ['']
 
         path = os.path.join(self.dump_dir, f'{base_commit}-{variant_id}-compile_commands.json')
         shutil.copy2('compile_commands.json', path)
+        self.artifacts.append(('file', path))
+
+        external = self.__external_config_stamp()
+        if external:
+            with open(self.__config_stamp_path(base_commit, variant_id), 'w') as f:
+                f.write(external)
 
         # store hashes of object files
-        path = os.path.join(self.dump_dir, f'{base_commit}-{variant_id}-hashes.json')
-        if not os.path.exists(path):
-            with open(path, 'w') as file:
-                json.dump(base_objects, file, sort_keys=True)
+        with self.span('hash_write'):
+            if not self.store.contains(base_commit, variant_id):
+                self.store.put(base_commit, variant_id, base_objects)
+        self.artifacts.append(('hashes', base_commit, variant_id))
 
         # try:
         #     self.post_run()
@@ -403,4 +1000,7 @@ class ProjectManager:
         #     git.clean()
         #     self.config()
 
+        if self.skip_unaffected:
+            results += [0]
+
         return results
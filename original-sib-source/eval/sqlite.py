@@ -59,6 +59,13 @@ class SQLiteManager(ProjectManager):
             check=True,
             stdout=DEVNULL)
 
+    def get_config_inputs(self):
+        return [
+            'configure',
+            'Makefile.in',
+            'VERSION',
+        ]
+
     def __fix_build(self):
         subprocess.run([
             'sed',
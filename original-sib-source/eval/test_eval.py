@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from eval import Git, run
+from projectmanager import ProjectManager
+
+
+def git(path, *args):
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args], cwd=path,
+                          check=True, text=True, capture_output=True).stdout.strip()
+
+
+class RecordingManager(ProjectManager):
+    """Builds nothing, but remembers the commits it built and fails the builds of fail_commits"""
+
+    def __init__(self, path, dump_dir, fail_commits=()):
+        super().__init__(path, None, None, None, dump_dir)
+        self.built = []
+        self.fail_commits = set(fail_commits)
+
+    def config(self):
+        pass
+
+    def build(self):
+        commit = git(self.path, 'rev-parse', 'HEAD')
+        self.built.append(commit)
+        if commit in self.fail_commits:
+            raise RuntimeError(f'build of {commit} broken')
+        with open('a.o', 'w') as f:
+            f.write(commit)
+
+    def compile_commands(self, _):
+        with open('compile_commands.json', 'w') as f:
+            f.write('[]')
+
+    def multipatchcheck(self, commit, variant_aware=False, check=False, change_commit=None):
+        return None
+
+    def get_random_variant(self):
+        return ['-b']
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmp, 'repo')
+        self.dump_dir = os.path.join(self.tmp, 'dump')
+        os.makedirs(self.repo)
+        os.makedirs(self.dump_dir)
+
+        git(self.repo, 'init', '-q')
+        self.commits = []
+        for i in range(5):
+            with open(os.path.join(self.repo, 'a.c'), 'w') as f:
+                f.write(f'int a = {i};\n')
+            git(self.repo, 'add', 'a.c')
+            git(self.repo, 'commit', '-q', '-m', str(i))
+            self.commits.append(git(self.repo, 'rev-parse', 'HEAD'))
+        # the first commit only starts the range
+        self.range = f'{self.commits[0]}..{self.commits[-1]}'
+        self.journal = os.path.join(self.dump_dir, 'progress-RecordingManager.jsonl')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def run_eval(self, resume, fail_commits=()):
+        project = RecordingManager(self.repo, self.dump_dir, fail_commits)
+        rows = run(Git(self.repo), self.range, project, False, False, 1, resume=resume)
+        return project.built, rows[1:]
+
+    def test_skips_journaled_pairs(self):
+        _, rows = self.run_eval(resume=False)
+
+        with open(self.journal, 'r') as f:
+            lines = f.readlines()
+        with open(self.journal, 'w') as f:
+            f.writelines(lines[:2])
+
+        built, resumed_rows = self.run_eval(resume=True)
+        self.assertEqual(built, [self.commits[3]])
+        self.assertEqual([row[:3] for row in resumed_rows], [row[:3] for row in rows])
+
+    def test_reruns_failed_pairs(self):
+        _, rows = self.run_eval(resume=False, fail_commits=[self.commits[2]])
+        self.assertEqual(rows[1][4], f'build of {self.commits[2]} failed')
+
+        built, rows = self.run_eval(resume=True)
+        self.assertEqual(built, [self.commits[2]])
+        self.assertEqual(len(rows[1]), len(rows[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
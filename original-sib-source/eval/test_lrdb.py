@@ -0,0 +1,93 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from lrdb import LRDB
+from projectmanager import ProjectManager
+
+# shared with the tests of mpc, so both answer the same check
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mpc', 'test', 'check')
+
+
+class LoadTest(unittest.TestCase):
+
+    def load_json(self, js):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'commit.json')
+            with open(path, 'w') as f:
+                json.dump(js, f)
+            return LRDB.load(path)
+
+    def test_load(self):
+        lrdb = self.load_json({
+            'repo': '/repo',
+            'variants': ['a', 'b'],
+            'used_lines': {'/repo/a.c': {'intervals': [{'start': 1, 'stop': 3, 'val': [2]},
+                                                       {'start': 3, 'stop': 6, 'val': [3]}]}},
+            'commands': {'a': None, 'b': '1234'},
+        })
+
+        index = lrdb.files['/repo/a.c']
+        self.assertEqual(lrdb.variant_names(index.find(1, 2)), ['b'])
+        self.assertEqual(lrdb.variant_names(index.find(4, 8)), ['a', 'b'])
+
+    def test_load_legacy(self):
+        # written by mpc before the LRDB stored bitsets, one interval per variant
+        lrdb = self.load_json({
+            'repo': '/repo',
+            'used_lines': {'/repo/a.c': {'intervals': [{'start': 1, 'stop': 5, 'val': 'b'},
+                                                       {'start': 3, 'stop': 8, 'val': 'a'}],
+                                         'max_len': 5, 'cov': None, 'overlaps_merged': False}},
+            'commands': {'a': None, 'b': '1234'},
+        })
+
+        self.assertEqual(lrdb.variants, ['a', 'b'])
+        self.assertEqual(lrdb.commands, {'a': None, 'b': '1234'})
+        index = lrdb.files['/repo/a.c']
+        self.assertEqual(lrdb.variant_names(index.find(1, 2)), ['b'])
+        self.assertEqual(lrdb.variant_names(index.find(4, 5)), ['a', 'b'])
+        self.assertEqual(lrdb.variant_names(index.find(6, 8)), ['a'])
+
+
+class AffectedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lrdb = LRDB.load(os.path.join(FIXTURE, 'base.json'))
+        with open(os.path.join(FIXTURE, 'base..change.json'), 'r') as f:
+            entry = json.load(f)
+        self.changes = {os.path.join(self.lrdb.repo, file): lines for file, lines in entry['files'].items()}
+        with open(os.path.join(FIXTURE, 'expected.json'), 'r') as f:
+            self.expected = json.load(f)
+
+    def test_like_mpc(self):
+        affected, files = self.lrdb.affected(self.changes, filter_asm=True)
+        self.assertEqual(affected, self.expected['affected'])
+        self.assertEqual(files, self.expected['files'])
+
+    def test_changed_commands(self):
+        # c has no recorded compilation database, like mpc it is not affected by one
+        self.assertEqual(self.lrdb.affected({}, changed_commands=['a', 'c']), (['a'], []))
+
+    def test_check_in_process(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            os.makedirs(os.path.join(dump_dir, 'info'))
+            os.makedirs(os.path.join(dump_dir, 'diffs'))
+            shutil.copy(os.path.join(FIXTURE, 'base.json'), os.path.join(dump_dir, 'info'))
+            shutil.copy(os.path.join(FIXTURE, 'base..change.json'), os.path.join(dump_dir, 'diffs'))
+            for commit, flags in [('base', '-O1'), ('change', '-O2')]:
+                with open(os.path.join(dump_dir, f'{commit}-c-compile_commands.json'), 'w') as f:
+                    json.dump([{'directory': '/repo', 'file': 'c.c', 'command': f'cc {flags} -c c.c'}], f)
+
+            project = ProjectManager('/repo', None, None, None, dump_dir)
+            project.check_in_process = True
+            report = project.check('base', 'change')
+
+        self.assertEqual(report['affected'], self.expected['affected'])
+        self.assertEqual(report['files'], self.expected['files'])
+        self.assertEqual(set(report['timings']), {'git', 'lrdb', 'lookup'})
+
+
+if __name__ == '__main__':
+    unittest.main()
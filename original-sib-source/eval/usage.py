@@ -2,15 +2,13 @@
 
 import os
 import sys
-import json
+
+from lrdb import LRDB
 
 repo = sys.argv[1]
 dump = sys.argv[2]
 
-with open(dump, 'r', encoding='utf8') as f:
-    js = json.load(f)
-
-file_intervals = js['used_lines']
+lrdb = LRDB.load(dump)
 internal_used_lines = 0
 internal_total_lines = 0
 internal_files = 0
@@ -19,7 +17,7 @@ external_total_lines = 0
 external_files = 0
 
 
-for file, intervals in file_intervals.items():
+for file, index in lrdb.files.items():
     if not os.path.exists(file):
         print(f'File not found: {file}')
         continue
@@ -27,9 +25,7 @@ for file, intervals in file_intervals.items():
     with open(file, 'r', encoding='utf8') as f:
         total_lines = sum(1 for _ in f)
 
-    used_lines = 0
-    for interval in intervals['intervals']:
-        used_lines += interval['stop'] - interval['start']
+    used_lines = index.used_lines()
 
     if file.startswith(repo):
         internal_used_lines += used_lines
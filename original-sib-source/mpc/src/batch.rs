@@ -0,0 +1,97 @@
+use std::fs::File;
+use std::path::{Path, PathBuf};
+
+use log::{debug, info, warn};
+use serde::Deserialize;
+
+use crate::diff_cache::DiffCacheEntry;
+use crate::plugin::UsageStorage;
+use crate::report::{Report, ReportWriter};
+use crate::session::Session;
+use crate::AnalyzeArgs;
+use crate::PARSE_USED_LINES;
+
+/// A single `--check-storage` run: is any variant of `commit` affected by the changes up to `change`?
+#[derive(Debug, Deserialize)]
+struct CheckRequest {
+    commit: String,
+    change: String,
+    compile_commands_path_map: Option<Vec<String>>,
+}
+
+/// Checks all requests in one process and writes one report per request to `output`
+pub fn check(
+    args: &AnalyzeArgs,
+    path: &Path,
+    requests: &Path,
+    output: &Path,
+) -> Result<(), std::io::Error> {
+    let requests: Vec<CheckRequest> = serde_json::from_reader(File::open(requests)?)?;
+    let storage = Path::new(args.storage.as_ref().unwrap());
+
+    let mut session = Session::default();
+    let mut writer = ReportWriter::create(output)?;
+
+    for request in requests {
+        info!("Checking {} -> {}", request.commit, request.change);
+        let mut report = Report::new(Some(request.commit.clone()), Some(request.change.clone()));
+
+        match check_request(args, path, storage, &request, &mut session, &mut report) {
+            Ok((variants, files)) => report.set_affected(variants, files),
+            Err(error) => {
+                warn!("{error}");
+                report.error = Some(error);
+            }
+        }
+
+        writer.write(&report)?;
+    }
+
+    Ok(())
+}
+
+fn check_request(
+    args: &AnalyzeArgs,
+    path: &Path,
+    storage: &Path,
+    request: &CheckRequest,
+    session: &mut Session,
+    report: &mut Report,
+) -> Result<(Vec<String>, Vec<PathBuf>), String> {
+    if !UsageStorage::<PARSE_USED_LINES>::exists(storage, &request.commit) {
+        return Err(format!("no storage for {}", request.commit));
+    }
+
+    let cached = args.diff_cache.as_ref().and_then(|dir| {
+        DiffCacheEntry::read(dir, &request.commit, &request.change)
+            .map_err(|e| debug!("No cached diff: {e}"))
+            .ok()
+    });
+    let hunks = match cached {
+        Some(entry) => report.time("git", || entry.changes(path)),
+        None => {
+            let repo = session.repo(path).map_err(|e| e.to_string())?;
+            report
+                .time("git", || {
+                    crate::git::analyze_commits(repo, path, &request.commit, &request.change)
+                })
+                .map_err(|e| e.to_string())?
+        }
+    };
+
+    let lrdb = report
+        .time("lrdb", || session.storage(storage, &request.commit))
+        .map_err(|e| e.to_string())?;
+    let compile_commands_map = session
+        .compile_commands_map(request.compile_commands_path_map.as_deref())
+        .map_err(|e| e.to_string())?;
+
+    Ok(report.time("lookup", || {
+        lrdb.affected_variants(
+            compile_commands_map,
+            &hunks,
+            args.compare_git.as_ref(),
+            args.filter_asm,
+        )
+    }))
+}
@@ -0,0 +1,165 @@
+use std::collections::HashMap;
+use std::io;
+use std::path::PathBuf;
+
+use git2::{DiffDelta, DiffHunk, Repository};
+use log::info;
+
+use crate::git::{self, Hunk};
+use crate::plugin::{IntervalTree, Segment, UsageStorage, VariantSet};
+use crate::CarryArgs;
+use crate::PARSE_USED_LINES;
+
+/// Changed `[start, stop)` lines of the base version, like `Change::Partly`, and how many lines they add
+type Shift = (u32, u32, i64);
+
+fn other_error(message: String) -> io::Error {
+    io::Error::new(io::ErrorKind::Other, message)
+}
+
+/// Hunks of every file changed from `base_commit` to `change_commit`, relative to the repository
+fn line_shifts(
+    repo: &Repository,
+    base_commit: &str,
+    change_commit: &str,
+) -> Result<HashMap<PathBuf, Vec<Shift>>, git2::Error> {
+    let diff = git::diff_trees(repo, base_commit, change_commit)?;
+
+    let mut shifts: HashMap<PathBuf, Vec<Shift>> = HashMap::new();
+    let mut hunk_cb = |delta: DiffDelta, hunk: DiffHunk| {
+        let delta_lines = i64::from(hunk.new_lines()) - i64::from(hunk.old_lines());
+        let lines = Hunk::from(hunk).old_lines;
+        shifts
+            .entry(delta.old_file().path().unwrap().to_path_buf())
+            .or_default()
+            .push((lines.start, lines.stop, delta_lines));
+        true
+    };
+    diff.foreach(&mut |_, _| true, None, Some(&mut hunk_cb), None)?;
+
+    for hunks in shifts.values_mut() {
+        hunks.sort_unstable();
+    }
+    Ok(shifts)
+}
+
+/// Moves sorted, disjoint `[start, stop)` ranges to their lines after the hunks, `None` if one is changed
+fn shift_ranges(ranges: &[(u32, u32)], hunks: &[Shift]) -> Option<Vec<(u32, u32)>> {
+    let mut shifted: Vec<(u32, u32)> = Vec::with_capacity(ranges.len());
+    let mut delta = 0;
+    let mut next = 0;
+
+    for &(start, stop) in ranges {
+        while next < hunks.len() && hunks[next].1 <= start {
+            delta += hunks[next].2;
+            next += 1;
+        }
+        if next < hunks.len() && hunks[next].0 < stop {
+            return None;
+        }
+
+        let (start, stop) = ((start as i64 + delta) as u32, (stop as i64 + delta) as u32);
+        // ranges separated by other variants' lines before may touch now
+        match shifted.last_mut() {
+            Some(last) if last.1 == start => last.1 = stop,
+            _ => shifted.push((start, stop)),
+        }
+    }
+
+    Some(shifted)
+}
+
+/// Stores the lines `args.variant` uses at `args.commit` under `args.change`, without building it again
+///
+/// Fails if the variant uses lines the changes touch, i.e. if `analyze --check-storage` reports it as affected.
+pub fn carry(args: &CarryArgs) -> Result<(), io::Error> {
+    let storage = UsageStorage::<PARSE_USED_LINES>::read_all(&args.storage, &args.commit)?
+        .ok_or_else(|| other_error(format!("no storage for {}", args.commit)))?;
+    let index = storage
+        .variants
+        .iter()
+        .position(|variant| *variant == args.variant)
+        .ok_or_else(|| other_error(format!("{} has no variant {}", args.commit, args.variant)))?;
+
+    let repo =
+        Repository::open(args.dir.canonicalize()?).map_err(|e| other_error(e.to_string()))?;
+    let shifts =
+        line_shifts(&repo, &args.commit, &args.change).map_err(|e| other_error(e.to_string()))?;
+
+    let mut used_lines = HashMap::new();
+    for (file, tree) in &storage.used_lines {
+        let ranges: Vec<(u32, u32)> = tree
+            .iter()
+            .filter(|segment| segment.val.iter().any(|i| i == index))
+            .map(|segment| (segment.start, segment.stop))
+            .collect();
+        if ranges.is_empty() {
+            continue;
+        }
+
+        let hunks = file
+            .strip_prefix(&storage.repo)
+            .ok()
+            .and_then(|file| shifts.get(file));
+        let ranges = match hunks {
+            Some(hunks) => shift_ranges(&ranges, hunks).ok_or_else(|| {
+                other_error(format!(
+                    "{} uses changed lines of {}",
+                    args.variant,
+                    file.display()
+                ))
+            })?,
+            None => ranges,
+        };
+
+        let segments = ranges
+            .into_iter()
+            .map(|(start, stop)| Segment {
+                start,
+                stop,
+                val: VariantSet::single(0),
+            })
+            .collect();
+        used_lines.insert(file.clone(), IntervalTree::new(segments));
+    }
+
+    info!(
+        "Carrying {} files of {} from {} to {}",
+        used_lines.len(),
+        args.variant,
+        args.commit,
+        args.change
+    );
+    let carried = UsageStorage::<PARSE_USED_LINES> {
+        repo: storage.repo.clone(),
+        variants: vec![args.variant.clone()],
+        used_lines,
+        commands: HashMap::from([(
+            args.variant.clone(),
+            storage.commands.get(&args.variant).cloned().flatten(),
+        )]),
+    };
+    carried.dump_segment(&args.storage, &args.change, args.storage_format)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn shift_unchanged() {
+        // 2 lines added after line 3, line 10 replaced by 3 lines, lines 20 and 21 removed
+        let hunks = [(3, 4, 2), (10, 11, 2), (20, 22, -2)];
+        assert_eq!(
+            shift_ranges(&[(1, 3), (4, 10), (11, 20), (22, 30)], &hunks),
+            Some(vec![(1, 3), (6, 12), (15, 32)])
+        );
+    }
+
+    #[test]
+    fn shift_changed() {
+        assert_eq!(shift_ranges(&[(1, 4)], &[(3, 4, 2)]), None);
+        assert_eq!(shift_ranges(&[(5, 8)], &[(1, 6, -5)]), None);
+        assert_eq!(shift_ranges(&[(1, 3)], &[]), Some(vec![(1, 3)]));
+    }
+}
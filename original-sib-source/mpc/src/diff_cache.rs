@@ -0,0 +1,118 @@
+use std::collections::{BTreeMap, HashMap};
+use std::fs::File;
+use std::io::{self, BufReader, BufWriter, Write};
+use std::path::{Path, PathBuf};
+
+use git2::Repository;
+use log::info;
+use rayon::prelude::*;
+use serde::{Deserialize, Serialize};
+
+use crate::git::{self, Change};
+use crate::plugin::Interval;
+use crate::DiffArgs;
+
+/// Changes between two commits, computed once by `mpc diff` and shared by every check of the pair
+///
+/// Paths are relative to the repository, so every worktree can use the same entry.
+#[derive(Debug, Deserialize, Serialize)]
+pub struct DiffCacheEntry {
+    /// Changed `[start, stop)` lines of the base version, `None` if the directives of the file are imbalanced
+    pub files: BTreeMap<PathBuf, Option<Vec<(u32, u32)>>>,
+    /// Every changed path, including binary files
+    pub paths: Vec<PathBuf>,
+}
+
+#[derive(Debug, Deserialize)]
+struct Pair {
+    commit: String,
+    change: String,
+}
+
+pub(crate) fn git_error(error: &git2::Error) -> io::Error {
+    io::Error::new(io::ErrorKind::Other, error.to_string())
+}
+
+impl DiffCacheEntry {
+    pub fn path(dir: &Path, commit: &str, change: &str) -> PathBuf {
+        dir.join(format!("{commit}..{change}.json"))
+    }
+
+    fn compute(repo: &Repository, commit: &str, change: &str) -> Result<Self, git2::Error> {
+        let (changes, paths) = git::diff_commits(repo, commit, change)?;
+
+        let files = changes
+            .into_iter()
+            .map(|(file, change)| {
+                let lines = match change {
+                    Change::Partly(hunks) => {
+                        Some(hunks.iter().map(|hunk| (hunk.start, hunk.stop)).collect())
+                    }
+                    Change::Full => None,
+                };
+                (file, lines)
+            })
+            .collect();
+
+        Ok(Self { files, paths })
+    }
+
+    pub fn read(dir: &Path, commit: &str, change: &str) -> Result<Self, io::Error> {
+        let reader = BufReader::new(File::open(Self::path(dir, commit, change))?);
+        Ok(serde_json::from_reader(reader)?)
+    }
+
+    /// The changes of the repository at `path`, like `git::analyze_repo` returns them
+    pub fn changes(&self, path: &Path) -> HashMap<PathBuf, Change> {
+        self.files
+            .iter()
+            .map(|(file, lines)| {
+                let change = match lines {
+                    Some(lines) => Change::Partly(
+                        lines
+                            .iter()
+                            .map(|&(start, stop)| Interval {
+                                start,
+                                stop,
+                                val: String::new(),
+                            })
+                            .collect(),
+                    ),
+                    None => Change::Full,
+                };
+                (path.join(file), change)
+            })
+            .collect()
+    }
+}
+
+/// Writes the entries of all `{commit, change}` pairs in `args.pairs` that are not cached yet
+pub fn precompute(args: &DiffArgs) -> Result<(), io::Error> {
+    let pairs: Vec<Pair> = serde_json::from_reader(BufReader::new(File::open(&args.pairs)?))?;
+    let dir = args.dir.canonicalize()?;
+    std::fs::create_dir_all(&args.output)?;
+
+    let pairs: Vec<&Pair> = pairs
+        .iter()
+        .filter(|pair| !DiffCacheEntry::path(&args.output, &pair.commit, &pair.change).exists())
+        .collect();
+    info!("Computing {} diffs...", pairs.len());
+
+    // repositories are not shared between threads, every worker opens its own
+    pairs.par_iter().try_for_each_init(
+        || Repository::open(&dir),
+        |repo, pair| {
+            let repo = repo.as_ref().map_err(git_error)?;
+            let entry = DiffCacheEntry::compute(repo, &pair.commit, &pair.change)
+                .map_err(|e| git_error(&e))?;
+
+            // renamed into place, so interrupted runs leave no partial entries behind
+            let path = DiffCacheEntry::path(&args.output, &pair.commit, &pair.change);
+            let tmp_path = path.with_extension("json.tmp");
+            let mut writer = BufWriter::new(File::create(&tmp_path)?);
+            serde_json::to_writer(&mut writer, &entry)?;
+            writer.flush()?;
+            std::fs::rename(tmp_path, path)
+        },
+    )
+}
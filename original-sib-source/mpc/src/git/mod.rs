@@ -3,7 +3,7 @@ use std::{
     path::{Path, PathBuf},
 };
 
-use git2::{DiffDelta, DiffHunk, DiffOptions, Repository};
+use git2::{Diff, DiffDelta, DiffHunk, DiffOptions, Repository};
 use log::{debug, trace};
 
 use crate::plugin::Interval;
@@ -50,16 +50,12 @@ fn check_hunk_balanced_directives(content: &str) -> bool {
     num_opened_directives == 0
 }
 
-pub fn analyze<P>(
-    path: P,
+/// Changes of the working directory (including the index) relative to `base_commit`, or to the index
+pub fn analyze_repo(
+    repo: &Repository,
+    path: &Path,
     base_commit: Option<&str>,
-) -> Result<HashMap<PathBuf, Change>, git2::Error>
-where
-    P: AsRef<Path>,
-{
-    let path = path.as_ref().canonicalize().unwrap();
-    let repo = Repository::open(&path)?;
-
+) -> Result<HashMap<PathBuf, Change>, git2::Error> {
     let mut diff_options = DiffOptions::default();
     diff_options.context_lines(0);
 
@@ -71,6 +67,53 @@ where
         repo.diff_index_to_workdir(None, Some(&mut diff_options))?
     };
 
+    collect_changes(path, &diff)
+}
+
+/// Like `analyze_repo`, but compares two commits without touching the working directory
+pub fn analyze_commits(
+    repo: &Repository,
+    path: &Path,
+    base_commit: &str,
+    change_commit: &str,
+) -> Result<HashMap<PathBuf, Change>, git2::Error> {
+    let diff = diff_trees(repo, base_commit, change_commit)?;
+    collect_changes(path, &diff)
+}
+
+/// Changes between two commits relative to the repository, and every changed path including binary files
+pub fn diff_commits(
+    repo: &Repository,
+    base_commit: &str,
+    change_commit: &str,
+) -> Result<(HashMap<PathBuf, Change>, Vec<PathBuf>), git2::Error> {
+    let diff = diff_trees(repo, base_commit, change_commit)?;
+    let paths = diff
+        .deltas()
+        .filter_map(|delta| delta.new_file().path().map(Path::to_path_buf))
+        .collect();
+
+    Ok((collect_changes(Path::new(""), &diff)?, paths))
+}
+
+pub fn diff_trees<'a>(
+    repo: &'a Repository,
+    base_commit: &str,
+    change_commit: &str,
+) -> Result<Diff<'a>, git2::Error> {
+    let mut diff_options = DiffOptions::default();
+    diff_options.context_lines(0);
+
+    let base_tree = repo.revparse_single(base_commit)?.peel_to_tree()?;
+    let change_tree = repo.revparse_single(change_commit)?.peel_to_tree()?;
+    repo.diff_tree_to_tree(
+        Some(&base_tree),
+        Some(&change_tree),
+        Some(&mut diff_options),
+    )
+}
+
+fn collect_changes(path: &Path, diff: &Diff) -> Result<HashMap<PathBuf, Change>, git2::Error> {
     let binary_cb = None;
     let line_cb = None;
 
@@ -115,7 +158,7 @@ where
         let file = diff_delta.old_file().path().unwrap();
         let file = path.join(file);
 
-        let mut patch = git2::Patch::from_diff(&diff, i).unwrap().unwrap();
+        let mut patch = git2::Patch::from_diff(diff, i).unwrap().unwrap();
         let binding = patch.to_buf().unwrap();
         let text_diff = binding.as_str().unwrap();
 
@@ -11,14 +11,24 @@ use rayon::prelude::*;
 use simple_logger::SimpleLogger;
 
 use crate::checkpoint::Checkpoint;
+use crate::diff_cache::{git_error, DiffCacheEntry};
 use crate::plugin::CompileCommands;
+use crate::plugin::StorageFormat;
 use crate::plugin::UsageStorage;
+use crate::report::{Format, Report, ReportWriter};
+use crate::session::Session;
 
+mod batch;
+mod carry;
 mod checkpoint;
+mod diff_cache;
 mod git;
 mod helper;
 mod interval;
 mod plugin;
+mod report;
+mod serve;
+mod session;
 
 #[derive(Parser, Debug)]
 #[command(author, version, about, long_about = None)]
@@ -40,7 +50,7 @@ struct DebugArgs {
 }
 
 #[derive(clap::Args, Debug)]
-struct AnalyzeArgs {
+pub struct AnalyzeArgs {
     #[arg(short, long)]
     commit: Option<String>,
 
@@ -62,9 +72,21 @@ struct AnalyzeArgs {
     #[arg(long, action, requires = "storage")]
     compile_commands: bool,
 
+    /// Format of dumped line range databases, existing ones are read in either format
+    #[arg(long, value_enum, default_value_t = StorageFormat::Json)]
+    storage_format: StorageFormat,
+
+    /// Merge the variants dumped for `commit` into a single database
+    #[arg(long, action, requires_all = ["storage", "commit"])]
+    compact: bool,
+
     #[arg(long, default_value_t = String::from("compile_commands.json"))]
     compile_commands_path: String,
 
+    /// Read the `o-info` files next to the outputs of the compile commands instead of searching `dir`
+    #[arg(long, action)]
+    info_from_compile_commands: bool,
+
     #[arg(long, action = clap::ArgAction::Append, num_args = 1..)]
     compile_commands_path_map: Option<Vec<String>>,
 
@@ -78,6 +100,29 @@ struct AnalyzeArgs {
     #[arg(long, action)]
     filter_asm: bool,
 
+    /// JSON list of `{commit, change, compile_commands_path_map}` to check in one run
+    #[arg(long, requires_all = ["storage", "output"])]
+    check_batch: Option<PathBuf>,
+
+    #[arg(long, value_enum, default_value_t = Format::Text, requires = "output")]
+    format: Format,
+
+    /// Where JSON results are written to, e.g. /dev/fd/3
+    #[arg(long)]
+    output: Option<PathBuf>,
+
+    /// Read the changes from `commit` to `change` from the entries `mpc diff` wrote to this directory
+    #[arg(long, requires = "commit")]
+    diff_cache: Option<PathBuf>,
+
+    /// Commit the working directory was changed to, entries of the diff cache are looked up by it
+    #[arg(long)]
+    change: Option<String>,
+
+    /// Store paths below `dir` as if `dir` was this directory (e.g. when building in a worktree)
+    #[arg(long)]
+    rebase_dir: Option<PathBuf>,
+
     dir: PathBuf,
 }
 
@@ -98,11 +143,59 @@ pub struct CheckpointArgs {
     dir: PathBuf,
 }
 
+#[derive(clap::Args, Debug)]
+pub struct ServeArgs {
+    /// Where the reports are written to, e.g. /dev/fd/3
+    #[arg(long)]
+    output: PathBuf,
+}
+
+#[derive(clap::Args, Debug)]
+pub struct DiffArgs {
+    /// JSON list of `{commit, change}` pairs
+    #[arg(long)]
+    pairs: PathBuf,
+
+    /// Directory of the cache, pairs that already have an entry are skipped
+    #[arg(long)]
+    output: PathBuf,
+
+    dir: PathBuf,
+}
+
+#[derive(clap::Args, Debug)]
+pub struct CarryArgs {
+    #[arg(short, long)]
+    storage: PathBuf,
+
+    /// Commit the variant was dumped for
+    #[arg(short, long)]
+    commit: String,
+
+    /// Commit to store the variant under
+    #[arg(long)]
+    change: String,
+
+    #[arg(short, long)]
+    variant: String,
+
+    #[arg(long, value_enum, default_value_t = StorageFormat::Json)]
+    storage_format: StorageFormat,
+
+    dir: PathBuf,
+}
+
 #[derive(Subcommand, Debug)]
 enum Commands {
     Debug(DebugArgs),
     Analyze(AnalyzeArgs),
     Checkpoint(CheckpointArgs),
+    /// Answer analyze requests read from stdin, one JSON object per line, keeping state across requests
+    Serve(ServeArgs),
+    /// Compute the changes of commit pairs once for `analyze --diff-cache`
+    Diff(DiffArgs),
+    /// Store the lines a variant uses at `commit` under `change`, which must not affect it
+    Carry(CarryArgs),
 }
 
 const PARSE_USED_LINES: bool = false;
@@ -149,18 +242,54 @@ fn test_for_usage(args: &DebugArgs) -> Result<(), std::io::Error> {
 }
 
 fn analyze(args: &AnalyzeArgs) -> Result<ExitCode, std::io::Error> {
+    if let Some(requests) = &args.check_batch {
+        let path = args.dir.canonicalize().unwrap();
+        batch::check(args, &path, requests, args.output.as_ref().unwrap())?;
+        return Ok(ExitCode::SUCCESS);
+    }
+
+    let (exit_code, report) = analyze_in(args, &mut Session::default())?;
+
+    if args.format == Format::Json {
+        ReportWriter::create(args.output.as_ref().unwrap())?.write(&report)?;
+    }
+
+    Ok(exit_code)
+}
+
+fn analyze_in(
+    args: &AnalyzeArgs,
+    session: &mut Session,
+) -> Result<(ExitCode, Report), std::io::Error> {
     let mut exit_code = ExitCode::SUCCESS;
-    let path = args.dir.canonicalize().unwrap();
+    let path = args.dir.canonicalize()?;
 
-    let compile_commands = if args.compile_commands {
+    let mut report = Report::new(args.commit.clone(), None);
+
+    if args.compact {
+        info!("Compacting storage...");
+        let now = Instant::now();
+        report.time("compact", || {
+            UsageStorage::<PARSE_USED_LINES>::compact(
+                args.storage.as_ref().unwrap(),
+                args.commit.as_ref().unwrap(),
+                args.storage_format,
+            )
+        })?;
+        info!("Completed in {:?}", Instant::now().duration_since(now));
+        return Ok((exit_code, report));
+    }
+
+    let cc_path = {
         let p = Path::new(&args.compile_commands_path);
-        let cc_path = if p.is_relative() {
+        if p.is_relative() {
             path.join(p)
         } else {
             p.to_path_buf()
-        };
-
-        Some(CompileCommands::read(cc_path)?)
+        }
+    };
+    let compile_commands = if args.compile_commands {
+        Some(session.compile_commands_hash(&cc_path)?)
     } else {
         None
     };
@@ -169,7 +298,25 @@ fn analyze(args: &AnalyzeArgs) -> Result<ExitCode, std::io::Error> {
     if !args.dump_only {
         info!("Loading git information...");
         let now = Instant::now();
-        hunks = Some(git::analyze(&path, args.commit.as_deref()).unwrap());
+        hunks = Some(report.time("git", || {
+            let cached = match (&args.diff_cache, &args.change) {
+                (Some(dir), Some(change)) => {
+                    DiffCacheEntry::read(dir, args.commit.as_ref().unwrap(), change)
+                        .map_err(|e| debug!("No cached diff: {e}"))
+                        .ok()
+                }
+                _ => None,
+            };
+
+            match cached {
+                Some(entry) => Ok(entry.changes(&path)),
+                None => {
+                    let repo = session.repo(&path).map_err(|e| git_error(&e))?;
+                    git::analyze_repo(repo, &path, args.commit.as_deref())
+                        .map_err(|e| git_error(&e))
+                }
+            }
+        })?);
         info!("Completed in {:?}", Instant::now().duration_since(now));
         // dbg!(&hunks);
     }
@@ -177,12 +324,24 @@ fn analyze(args: &AnalyzeArgs) -> Result<ExitCode, std::io::Error> {
     if !args.check_storage || args.dump || args.dump_only {
         info!("Loading build information...");
         let now = Instant::now();
-        let storage = UsageStorage::<PARSE_USED_LINES>::from(
-            &path,
-            compile_commands.clone(),
-            args.variant.clone().unwrap_or_default(),
-        )
-        .unwrap();
+        let mut storage = report.time("ingest", || {
+            let variant = args.variant.clone().unwrap_or_default();
+            if args.info_from_compile_commands {
+                let info_files = CompileCommands::info_files(&cc_path)?;
+                debug!("{} info files listed", info_files.len());
+                UsageStorage::<PARSE_USED_LINES>::from_info_files(
+                    &path,
+                    &info_files,
+                    compile_commands.clone(),
+                    variant,
+                )
+            } else {
+                UsageStorage::<PARSE_USED_LINES>::from(&path, compile_commands.clone(), variant)
+            }
+        })?;
+        if let Some(rebase_dir) = &args.rebase_dir {
+            storage.rebase(&path, rebase_dir.canonicalize()?);
+        }
         info!("Completed in {:?}", Instant::now().duration_since(now));
 
         // dbg!(&storage.data);
@@ -263,10 +422,13 @@ fn analyze(args: &AnalyzeArgs) -> Result<ExitCode, std::io::Error> {
             info!("Dumping data...");
             let now = Instant::now();
 
-            storage.dump_to_dir_accu(
-                args.storage.as_ref().unwrap(),
-                args.commit.as_deref().unwrap_or("unknown"),
-            )?;
+            report.time("dump", || {
+                storage.dump_segment(
+                    args.storage.as_ref().unwrap(),
+                    args.commit.as_deref().unwrap_or("unknown"),
+                    args.storage_format,
+                )
+            })?;
 
             info!("Completed in {:?}", Instant::now().duration_since(now));
         }
@@ -276,14 +438,22 @@ fn analyze(args: &AnalyzeArgs) -> Result<ExitCode, std::io::Error> {
         let hunks = hunks.unwrap();
         info!("Analyzing impact...");
         let now = Instant::now();
-        let mut variants = UsageStorage::<PARSE_USED_LINES>::find_affected_variants(
-            args.storage.as_ref().unwrap(),
-            args.commit.as_ref().unwrap(),
-            args.compile_commands_path_map.clone(),
-            hunks,
-            args.compare_git.as_ref(),
-            args.filter_asm,
-        )?;
+        let storage = report.time("lrdb", || {
+            session.storage(
+                Path::new(args.storage.as_ref().unwrap()),
+                args.commit.as_ref().unwrap(),
+            )
+        })?;
+        let compile_commands_map =
+            session.compile_commands_map(args.compile_commands_path_map.as_deref())?;
+        let (mut variants, files) = report.time("lookup", || {
+            storage.affected_variants(
+                compile_commands_map,
+                &hunks,
+                args.compare_git.as_ref(),
+                args.filter_asm,
+            )
+        });
 
         if args.compare_checkpoints {
             let mut additional_variants = Checkpoint::find_affected_variants(
@@ -295,9 +465,10 @@ fn analyze(args: &AnalyzeArgs) -> Result<ExitCode, std::io::Error> {
         }
         info!("Completed in {:?}", Instant::now().duration_since(now));
         info!("{variants:?} affected");
+        report.set_affected(variants, files);
     }
 
-    Ok(exit_code)
+    Ok((exit_code, report))
 }
 
 fn main() -> Result<ExitCode, std::io::Error> {
@@ -312,6 +483,9 @@ fn main() -> Result<ExitCode, std::io::Error> {
         Commands::Debug(args) => test_for_usage(args).map(|_| ExitCode::SUCCESS),
         Commands::Analyze(args) => analyze(args),
         Commands::Checkpoint(args) => Checkpoint::create(args).map(|_| ExitCode::SUCCESS),
+        Commands::Serve(args) => serve::serve(args).map(|_| ExitCode::SUCCESS),
+        Commands::Diff(args) => diff_cache::precompute(args).map(|_| ExitCode::SUCCESS),
+        Commands::Carry(args) => carry::carry(args).map(|_| ExitCode::SUCCESS),
     };
 
     result.unwrap();
@@ -1,6 +1,7 @@
 use std::path::Path;
 use std::path::PathBuf;
 
+use log::debug;
 use serde::Deserialize;
 use serde::Serialize;
 
@@ -31,6 +32,36 @@ impl CompileCommands {
         Ok(commands.hash())
     }
 
+    /// Lists the `o-info` files the plugin writes next to the object file of every command
+    ///
+    /// Only the files that exist are returned, e.g. assembler sources are compiled without the plugin.
+    pub fn info_files<P: AsRef<Path>>(path: P) -> Result<Vec<PathBuf>, std::io::Error> {
+        let data = std::fs::read_to_string(path)?;
+        let commands: Vec<CompileCommand> = serde_json::from_str(&data)?;
+
+        let mut info_files: Vec<PathBuf> = commands
+            .iter()
+            .filter_map(CompileCommand::output)
+            .map(|output| {
+                // the plugin appends to the whole output name, `f.o` becomes `f.o-info`
+                let mut info_file = output.into_os_string();
+                info_file.push("-info");
+                PathBuf::from(info_file)
+            })
+            .collect();
+        info_files.sort();
+        info_files.dedup();
+        info_files.retain(|info_file| {
+            let exists = info_file.is_file();
+            if !exists {
+                debug!("Missing {info_file:?}");
+            }
+            exists
+        });
+
+        Ok(info_files)
+    }
+
     pub fn hash(&mut self) -> String {
         self.commands
             .sort_by(|a, b| a.file.partial_cmp(&b.file).unwrap());
@@ -45,3 +76,137 @@ impl CompileCommands {
         hash.to_string()
     }
 }
+
+impl CompileCommand {
+    /// Object file written by the command, relative to `directory` unless absolute
+    fn output(&self) -> Option<PathBuf> {
+        let output = match &self.output {
+            Some(output) => PathBuf::from(output),
+            None => {
+                let arguments = match (&self.arguments, &self.command) {
+                    (Some(arguments), _) => arguments.clone(),
+                    (None, Some(command)) => split_command(command),
+                    (None, None) => return None,
+                };
+                output_argument(&arguments, &self.file)?
+            }
+        };
+
+        Some(self.directory.join(output))
+    }
+}
+
+fn output_argument(arguments: &[String], file: &Path) -> Option<PathBuf> {
+    let mut iter = arguments.iter();
+    while let Some(argument) = iter.next() {
+        if argument == "-o" {
+            return iter.next().map(PathBuf::from);
+        }
+        if let Some(output) = argument.strip_prefix("-o") {
+            return Some(PathBuf::from(output));
+        }
+    }
+
+    // without -o the compiler writes `file.o` to the working directory
+    if arguments.iter().any(|argument| argument == "-c") {
+        return Some(PathBuf::from(file.file_name()?).with_extension("o"));
+    }
+    None
+}
+
+/// Splits a shell command line into arguments, honoring quotes and backslash escapes
+fn split_command(command: &str) -> Vec<String> {
+    let mut arguments = vec![];
+    let mut argument = String::new();
+    let mut in_argument = false;
+    let mut quote = None;
+    let mut chars = command.chars();
+
+    while let Some(c) = chars.next() {
+        match (quote, c) {
+            (Some(q), c) if c == q => quote = None,
+            (Some('"'), '\\') | (None, '\\') => {
+                if let Some(escaped) = chars.next() {
+                    argument.push(escaped);
+                }
+                in_argument = true;
+            }
+            (Some(_), c) => argument.push(c),
+            (None, '"' | '\'') => {
+                quote = Some(c);
+                in_argument = true;
+            }
+            (None, c) if c.is_whitespace() => {
+                if in_argument {
+                    arguments.push(std::mem::take(&mut argument));
+                    in_argument = false;
+                }
+            }
+            (None, c) => {
+                argument.push(c);
+                in_argument = true;
+            }
+        }
+    }
+    if in_argument {
+        arguments.push(argument);
+    }
+
+    arguments
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn split() {
+        assert_eq!(
+            split_command(r#"cc -DNAME="\"a b\"" 'x y'  -c  f.c"#),
+            vec!["cc", r#"-DNAME="a b""#, "x y", "-c", "f.c"]
+        );
+    }
+
+    #[test]
+    fn output() {
+        let command = |command: &str| CompileCommand {
+            directory: PathBuf::from("/build"),
+            file: PathBuf::from("src/f.c"),
+            command: Some(command.to_owned()),
+            arguments: None,
+            output: None,
+        };
+
+        assert_eq!(
+            command("cc -c -o obj/f.o src/f.c").output(),
+            Some(PathBuf::from("/build/obj/f.o"))
+        );
+        assert_eq!(
+            command("cc -c -o/tmp/f.o src/f.c").output(),
+            Some(PathBuf::from("/tmp/f.o"))
+        );
+        assert_eq!(
+            command("cc -c src/f.c").output(),
+            Some(PathBuf::from("/build/f.o"))
+        );
+        assert_eq!(command("cc -E src/f.c").output(), None);
+    }
+
+    #[test]
+    fn info_files() {
+        let dir = std::env::temp_dir().join(format!("mpc-info-files-{}", std::process::id()));
+        std::fs::create_dir_all(dir.join("obj")).unwrap();
+        std::fs::write(dir.join("obj/f.o-info"), "{}").unwrap();
+
+        let commands = serde_json::json!([
+            {"directory": dir, "file": "f.c", "command": "cc -c -o obj/f.o f.c"},
+            {"directory": dir, "file": "g.S", "command": "cc -c -o obj/g.o g.S"},
+        ]);
+        let path = dir.join("compile_commands.json");
+        std::fs::write(&path, commands.to_string()).unwrap();
+
+        let info_files = CompileCommands::info_files(&path).unwrap();
+        std::fs::remove_dir_all(&dir).unwrap();
+        assert_eq!(info_files, vec![dir.join("obj/f.o-info")]);
+    }
+}
@@ -1,4 +1,5 @@
-use std::path::PathBuf;
+use std::io::BufReader;
+use std::path::{Path, PathBuf};
 
 use serde::Deserialize;
 
@@ -7,8 +8,22 @@ use crate::interval::Interval;
 #[derive(Debug, Deserialize)]
 pub struct Info {
     pub tu: PathBuf,
-    pub args: String,
-    pub files: Vec<File>,
+    /// Only recorded if the plugin ran with `SIB_RECORD_ARGS`
+    pub args: Option<String>,
+    /// Directory of the records `files` refer to by key, set if the plugin ran with `SIB_INFO_STORE`
+    pub store: Option<PathBuf>,
+    pub files: Vec<FileEntry>,
+}
+
+/// A file record, either inline or written once per build to the store and referred to by its content key
+#[derive(Debug, Deserialize)]
+#[serde(untagged)]
+pub enum FileEntry {
+    Inline(File),
+    Ref {
+        #[serde(rename = "ref")]
+        key: String,
+    },
 }
 
 #[derive(Debug, Deserialize)]
@@ -18,3 +33,10 @@ pub struct File {
 
     pub skips: Vec<Interval>,
 }
+
+impl File {
+    pub fn from_store(store: &Path, key: &str) -> Result<Self, std::io::Error> {
+        let reader = BufReader::new(std::fs::File::open(store.join(format!("{key}.json")))?);
+        Ok(serde_json::from_reader(reader)?)
+    }
+}
@@ -0,0 +1,413 @@
+//! Binary line range database
+//!
+//! Integers are little endian `u32` unless noted, strings are a `u32` length followed by the bytes.
+//!
+//! ```text
+//! magic "LRDB", version
+//! #variants, #files, #segments, #sets, #words per set
+//! repo
+//! #variants * (variant, kind: u8, [hash if kind is 2])
+//! #files * (path, first segment, #segments, max segment length)
+//! zero padding to a multiple of 8
+//! #sets * #words * u64, the distinct variant bitsets
+//! #segments * start, #segments * stop, #segments * set index
+//! ```
+//!
+//! The segments of a file are a contiguous range of the three columns, sorted by start, so readers can
+//! memory-map the file and search them in place. The variants are listed in bit order, `kind` is 1 for
+//! variants without and 2 for variants with a compile commands hash.
+
+use std::collections::HashMap;
+use std::ffi::OsStr;
+use std::io::{Error, ErrorKind};
+use std::os::unix::ffi::OsStrExt;
+use std::path::{Path, PathBuf};
+
+use serde::Deserialize;
+
+use super::variant_set::merge_segments;
+use super::IntervalTree;
+use super::Segment;
+use super::UsageStorage;
+use super::VariantSet;
+
+const MAGIC: &[u8; 4] = b"LRDB";
+const VERSION: u32 = 2;
+
+#[derive(clap::ValueEnum, Clone, Copy, Debug, PartialEq, Eq)]
+pub enum StorageFormat {
+    /// `{commit}.json`, serialized `UsageStorage`
+    Json,
+    /// `{commit}.lrdb`, interned variants and columnar segments
+    Binary,
+}
+
+impl StorageFormat {
+    pub fn extension(self) -> &'static str {
+        match self {
+            StorageFormat::Json => "json",
+            StorageFormat::Binary => "lrdb",
+        }
+    }
+
+    pub fn from_path(path: &Path) -> Option<Self> {
+        match path.extension()?.to_str()? {
+            "json" => Some(StorageFormat::Json),
+            "lrdb" => Some(StorageFormat::Binary),
+            _ => None,
+        }
+    }
+}
+
+fn put_u32(buf: &mut Vec<u8>, value: u32) {
+    buf.extend_from_slice(&value.to_le_bytes());
+}
+
+fn put_bytes(buf: &mut Vec<u8>, bytes: &[u8]) {
+    put_u32(buf, bytes.len() as u32);
+    buf.extend_from_slice(bytes);
+}
+
+fn invalid(message: &str) -> Error {
+    Error::new(ErrorKind::InvalidData, message)
+}
+
+/// JSON database written before the variants were stored as bitsets, `val` names the variant of an interval
+#[derive(Deserialize)]
+struct LegacyStorage {
+    repo: PathBuf,
+    used_lines: HashMap<PathBuf, LegacyTree>,
+    commands: HashMap<String, Option<String>>,
+}
+
+#[derive(Deserialize)]
+struct LegacyTree {
+    intervals: Vec<LegacyInterval>,
+}
+
+#[derive(Deserialize)]
+struct LegacyInterval {
+    start: u32,
+    stop: u32,
+    val: String,
+}
+
+impl<const PARSES_USED_LINES: bool> From<LegacyStorage> for UsageStorage<PARSES_USED_LINES> {
+    fn from(legacy: LegacyStorage) -> Self {
+        let mut variants: Vec<String> = legacy.commands.keys().cloned().collect();
+        variants.sort();
+        let mut index: HashMap<String, usize> = variants
+            .iter()
+            .enumerate()
+            .map(|(i, variant)| (variant.clone(), i))
+            .collect();
+
+        let mut used_lines = HashMap::with_capacity(legacy.used_lines.len());
+        for (path, tree) in legacy.used_lines {
+            // the intervals of different variants overlap, every variant is merged in as its own bit
+            let mut ranges: Vec<Vec<(u32, u32)>> = vec![vec![]; variants.len()];
+            for interval in tree.intervals {
+                let i = *index.entry(interval.val.clone()).or_insert_with(|| {
+                    variants.push(interval.val);
+                    ranges.push(vec![]);
+                    variants.len() - 1
+                });
+                ranges[i].push((interval.start, interval.stop));
+            }
+
+            let mut merged: Vec<Segment> = vec![];
+            for (i, mut ranges) in ranges.into_iter().enumerate() {
+                ranges.sort_unstable();
+                let mut segments: Vec<Segment> = vec![];
+                for (start, stop) in ranges {
+                    match segments.last_mut() {
+                        Some(last) if start <= last.stop => last.stop = last.stop.max(stop),
+                        _ => segments.push(Segment {
+                            start,
+                            stop,
+                            val: VariantSet::single(i),
+                        }),
+                    }
+                }
+                merged = merge_segments(&merged, &segments);
+            }
+            used_lines.insert(path, IntervalTree::new(merged));
+        }
+
+        let mut commands = legacy.commands;
+        for variant in &variants {
+            commands.entry(variant.clone()).or_default();
+        }
+
+        Self {
+            repo: legacy.repo,
+            variants,
+            used_lines,
+            commands,
+        }
+    }
+}
+
+struct Reader<'a> {
+    data: &'a [u8],
+    pos: usize,
+}
+
+impl<'a> Reader<'a> {
+    fn take(&mut self, len: usize) -> Result<&'a [u8], Error> {
+        let bytes = self
+            .data
+            .get(self.pos..self.pos + len)
+            .ok_or_else(|| Error::new(ErrorKind::UnexpectedEof, "truncated LRDB"))?;
+        self.pos += len;
+        Ok(bytes)
+    }
+
+    fn u32(&mut self) -> Result<u32, Error> {
+        Ok(u32::from_le_bytes(self.take(4)?.try_into().unwrap()))
+    }
+
+    fn bytes(&mut self) -> Result<&'a [u8], Error> {
+        let len = self.u32()? as usize;
+        self.take(len)
+    }
+
+    fn string(&mut self) -> Result<String, Error> {
+        String::from_utf8(self.bytes()?.to_vec()).map_err(|e| Error::new(ErrorKind::InvalidData, e))
+    }
+
+    fn column(&mut self, len: usize) -> Result<Vec<u32>, Error> {
+        Ok(self
+            .take(len * 4)?
+            .chunks_exact(4)
+            .map(|b| u32::from_le_bytes(b.try_into().unwrap()))
+            .collect())
+    }
+}
+
+impl<const PARSES_USED_LINES: bool> UsageStorage<PARSES_USED_LINES> {
+    pub fn to_binary(&self) -> Vec<u8> {
+        let mut files: Vec<(&PathBuf, &IntervalTree)> = self.used_lines.iter().collect();
+        files.sort_by(|a, b| a.0.cmp(b.0));
+
+        let num_segments: usize = files.iter().map(|(_, tree)| tree.len()).sum();
+        let mut starts = Vec::with_capacity(num_segments);
+        let mut stops = Vec::with_capacity(num_segments);
+        let mut values = Vec::with_capacity(num_segments);
+        let mut ranges = Vec::with_capacity(files.len());
+
+        // few distinct sets are shared by many segments
+        let mut sets: Vec<&VariantSet> = vec![];
+        let mut set_ids: HashMap<&VariantSet, u32> = HashMap::new();
+
+        for (_, tree) in &files {
+            ranges.push((starts.len() as u32, tree.len() as u32, tree.max_len));
+            // the segments of a Lapper are sorted by start
+            for segment in tree.iter() {
+                starts.push(segment.start);
+                stops.push(segment.stop);
+                let next_id = sets.len() as u32;
+                values.push(*set_ids.entry(&segment.val).or_insert_with(|| {
+                    sets.push(&segment.val);
+                    next_id
+                }));
+            }
+        }
+        let num_words = sets.iter().map(|set| set.words().len()).max().unwrap_or(0);
+
+        let mut buf = Vec::with_capacity(64 + sets.len() * num_words * 8 + num_segments * 12);
+        buf.extend_from_slice(MAGIC);
+        put_u32(&mut buf, VERSION);
+        put_u32(&mut buf, self.variants.len() as u32);
+        put_u32(&mut buf, files.len() as u32);
+        put_u32(&mut buf, num_segments as u32);
+        put_u32(&mut buf, sets.len() as u32);
+        put_u32(&mut buf, num_words as u32);
+        put_bytes(&mut buf, self.repo.as_os_str().as_bytes());
+
+        for variant in &self.variants {
+            put_bytes(&mut buf, variant.as_bytes());
+            match self.commands.get(variant) {
+                Some(Some(hash)) => {
+                    buf.push(2);
+                    put_bytes(&mut buf, hash.as_bytes());
+                }
+                _ => buf.push(1),
+            }
+        }
+
+        for ((path, _), (first, len, max_len)) in files.iter().zip(ranges) {
+            put_bytes(&mut buf, path.as_os_str().as_bytes());
+            put_u32(&mut buf, first);
+            put_u32(&mut buf, len);
+            put_u32(&mut buf, max_len);
+        }
+
+        buf.resize(buf.len().next_multiple_of(8), 0);
+        for set in sets {
+            let words = set.words();
+            for i in 0..num_words {
+                buf.extend_from_slice(&words.get(i).copied().unwrap_or(0).to_le_bytes());
+            }
+        }
+        for column in [starts, stops, values] {
+            for value in column {
+                put_u32(&mut buf, value);
+            }
+        }
+
+        buf
+    }
+
+    pub fn from_binary(data: &[u8]) -> Result<Self, Error> {
+        let mut reader = Reader { data, pos: 0 };
+        if reader.take(4)? != MAGIC || reader.u32()? != VERSION {
+            return Err(invalid("not an LRDB"));
+        }
+
+        let num_variants = reader.u32()? as usize;
+        let num_files = reader.u32()? as usize;
+        let num_segments = reader.u32()? as usize;
+        let num_sets = reader.u32()? as usize;
+        let num_words = reader.u32()? as usize;
+        let repo = PathBuf::from(OsStr::from_bytes(reader.bytes()?));
+
+        let mut variants = Vec::with_capacity(num_variants);
+        let mut commands = HashMap::with_capacity(num_variants);
+        for _ in 0..num_variants {
+            let variant = reader.string()?;
+            let hash = match reader.take(1)?[0] {
+                2 => Some(reader.string()?),
+                _ => None,
+            };
+            commands.insert(variant.clone(), hash);
+            variants.push(variant);
+        }
+
+        let mut files = Vec::with_capacity(num_files);
+        for _ in 0..num_files {
+            let path = PathBuf::from(OsStr::from_bytes(reader.bytes()?));
+            let first = reader.u32()? as usize;
+            let len = reader.u32()? as usize;
+            reader.u32()?;
+            if first + len > num_segments {
+                return Err(invalid("segment range out of bounds"));
+            }
+            files.push((path, first, len));
+        }
+
+        reader.take(reader.pos.next_multiple_of(8) - reader.pos)?;
+        let sets = reader
+            .take(num_sets * num_words * 8)?
+            .chunks_exact(num_words.max(1) * 8)
+            .map(|set| {
+                let words = set
+                    .chunks_exact(8)
+                    .map(|b| u64::from_le_bytes(b.try_into().unwrap()))
+                    .collect();
+                VariantSet::from_words(words)
+            })
+            .collect::<Vec<_>>();
+        let starts = reader.column(num_segments)?;
+        let stops = reader.column(num_segments)?;
+        let values = reader.column(num_segments)?;
+
+        let mut used_lines = HashMap::with_capacity(num_files);
+        for (path, first, len) in files {
+            let segments = (first..first + len)
+                .map(|i| {
+                    let set = sets
+                        .get(values[i] as usize)
+                        .ok_or_else(|| invalid("unknown variant set"))?;
+                    Ok(Segment {
+                        start: starts[i],
+                        stop: stops[i],
+                        val: set.clone(),
+                    })
+                })
+                .collect::<Result<Vec<_>, Error>>()?;
+            used_lines.insert(path, IntervalTree::new(segments));
+        }
+
+        Ok(Self {
+            repo,
+            variants,
+            used_lines,
+            commands,
+        })
+    }
+
+    /// Returns the database of `commit` in `dir` and its format, if there is one
+    pub fn find<P: AsRef<Path>>(dir: P, commit: &str) -> Option<(PathBuf, StorageFormat)> {
+        [StorageFormat::Binary, StorageFormat::Json]
+            .into_iter()
+            .map(|format| {
+                let path = dir.as_ref().join(commit).with_extension(format.extension());
+                (path, format)
+            })
+            .find(|(path, _)| path.exists())
+    }
+
+    pub fn read<P: AsRef<Path>>(path: P, format: StorageFormat) -> Result<Self, Error> {
+        match format {
+            StorageFormat::Json => Self::from_json(&std::fs::read_to_string(path)?),
+            StorageFormat::Binary => Self::from_binary(&std::fs::read(path)?),
+        }
+    }
+
+    /// Parses a JSON database, also one written before the variants were stored as bitsets
+    fn from_json(content: &str) -> Result<Self, Error> {
+        match serde_json::from_str(content) {
+            Ok(storage) => Ok(storage),
+            Err(error) => match serde_json::from_str::<LegacyStorage>(content) {
+                Ok(legacy) => Ok(legacy.into()),
+                // report why the current format does not match
+                Err(_) => Err(error.into()),
+            },
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn read_legacy_json() {
+        // written by mpc before the LRDB stored bitsets, serialized `Lapper`s with one interval per variant
+        let legacy = r#"{
+            "repo": "/repo",
+            "used_lines": {
+                "/repo/a.c": {
+                    "intervals": [
+                        {"start": 1, "stop": 5, "val": "b"},
+                        {"start": 3, "stop": 8, "val": "a"},
+                        {"start": 4, "stop": 6, "val": "b"}
+                    ],
+                    "max_len": 5,
+                    "cov": null,
+                    "overlaps_merged": false
+                }
+            },
+            "commands": {"a": null, "b": "1234"}
+        }"#;
+
+        let storage = UsageStorage::<true>::from_json(legacy).unwrap();
+        assert_eq!(storage.variants, vec!["a", "b"]);
+        assert_eq!(storage.commands["b"], Some("1234".to_owned()));
+
+        let segments: Vec<(u32, u32, Vec<usize>)> = storage.used_lines[Path::new("/repo/a.c")]
+            .iter()
+            .map(|segment| (segment.start, segment.stop, segment.val.iter().collect()))
+            .collect();
+        assert_eq!(
+            segments,
+            vec![(1, 3, vec![1]), (3, 6, vec![0, 1]), (6, 8, vec![0])]
+        );
+    }
+
+    #[test]
+    fn read_invalid_json() {
+        assert!(UsageStorage::<true>::from_json(r#"{"repo": "/repo"}"#).is_err());
+    }
+}
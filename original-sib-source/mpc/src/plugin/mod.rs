@@ -1,21 +1,26 @@
 pub use compile_commands::CompileCommands;
+pub use lrdb::StorageFormat;
 pub use usage_storage::UsageStorage;
+pub use variant_set::VariantSet;
 
 pub type Interval = rust_lapper::Interval<u32, String>;
-pub type IntervalTree = rust_lapper::Lapper<u32, String>;
+/// Lines used by a set of variants
+pub type Segment = rust_lapper::Interval<u32, VariantSet>;
+/// Disjoint segments of a file
+pub type IntervalTree = rust_lapper::Lapper<u32, VariantSet>;
 
 use std::ffi::OsStr;
 use std::path::{Path, PathBuf};
 
 mod compile_commands;
 mod info;
+mod lrdb;
 mod usage_storage;
-
-use info::Info;
+mod variant_set;
 
 const INFO_EXTENSION: &str = "o-info";
 
-fn list_info_files(dir: &Path) -> Vec<PathBuf> {
+fn list_info_files(dir: &Path) -> Result<Vec<PathBuf>, std::io::Error> {
     let ext = Some(OsStr::new(INFO_EXTENSION));
 
     let a = walkdir::WalkDir::new(dir)
@@ -31,14 +36,12 @@ fn list_info_files(dir: &Path) -> Vec<PathBuf> {
                 })
                 .transpose()
         })
-        .collect::<Result<Vec<_>, _>>();
-
-    let a = a.unwrap();
+        .collect::<Result<Vec<_>, _>>()?;
 
     #[cfg(debug_assertions)]
     if a.is_empty() {
         log::warn!("No {INFO_EXTENSION} files found!");
     }
 
-    a
+    Ok(a)
 }
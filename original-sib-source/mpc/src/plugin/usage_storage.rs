@@ -1,7 +1,9 @@
 use std::collections::hash_map::Entry;
 use std::collections::HashMap;
 use std::collections::HashSet;
+use std::fs::File;
 use std::io;
+use std::io::BufReader;
 use std::path::Path;
 use std::path::PathBuf;
 
@@ -10,17 +12,22 @@ use rayon::prelude::*;
 use serde::Deserialize;
 use serde::Serialize;
 
-use super::Info;
-use super::Interval;
+use super::info;
+use super::info::{FileEntry, Info};
+use super::variant_set::merge_segments;
 use super::IntervalTree;
+use super::Segment;
+use super::StorageFormat;
+use super::VariantSet;
 use crate::git::Change;
 use crate::interval;
-use crate::CompileCommands;
 
 // TODO: rename "skips" and others
 #[derive(Clone, Debug, Deserialize, Serialize)]
 pub struct UsageStorage<const PARSES_USED_LINES: bool> {
     pub repo: PathBuf,
+    /// Bit `i` of a segment's `VariantSet` refers to `variants[i]`
+    pub variants: Vec<String>,
     pub used_lines: HashMap<PathBuf, IntervalTree>,
     pub commands: HashMap<String, Option<String>>, // Variant -> CompileCommands Hash
 }
@@ -31,67 +38,118 @@ impl<const PARSES_USED_LINES: bool> UsageStorage<PARSES_USED_LINES> {
         compile_commands_hash: Option<String>,
         variant: String,
     ) -> Result<Self, io::Error> {
-        let infos: Vec<(PathBuf, Vec<Interval>)> = super::list_info_files(repo.as_ref())
+        let info_files = super::list_info_files(repo.as_ref())?;
+        Self::from_info_files(repo, &info_files, compile_commands_hash, variant)
+    }
+
+    /// Like `from`, but reads the given `o-info` files instead of searching the tree for them
+    pub fn from_info_files<P: AsRef<Path>>(
+        repo: P,
+        info_files: &[PathBuf],
+        compile_commands_hash: Option<String>,
+        variant: String,
+    ) -> Result<Self, io::Error> {
+        // every worker folds the info files it reads into per-file ranges, so memory grows with the number of
+        // used files instead of the number of translation units times the files they include
+        let (used_lines, _) = info_files
             .par_iter()
-            .map(|info_file| {
-                let data = std::fs::read_to_string(info_file).unwrap();
-                let info: Info = serde_json::from_str(&data).unwrap();
+            .try_fold(
+                || {
+                    (
+                        HashMap::<PathBuf, UsedRanges>::new(),
+                        HashSet::<String>::new(),
+                    )
+                },
+                |(mut used_lines, mut resolved), info_file| {
+                    let reader = BufReader::new(File::open(info_file)?);
+                    let Info { store, files, .. } = serde_json::from_reader(reader)?;
+
+                    for entry in files {
+                        let file = match entry {
+                            FileEntry::Inline(file) => file,
+                            // a record that was already folded adds no used lines
+                            FileEntry::Ref { key } if resolved.contains(&key) => continue,
+                            FileEntry::Ref { key } => {
+                                let store = store.as_deref().ok_or_else(|| {
+                                    io::Error::new(
+                                        io::ErrorKind::InvalidData,
+                                        format!("{info_file:?} references {key} without store"),
+                                    )
+                                })?;
+                                let file = info::File::from_store(store, &key)?;
+                                resolved.insert(key);
+                                file
+                            }
+                        };
 
-                info.files
-                    .into_iter()
-                    .map(|file| {
                         let mut skipped = file.skips;
                         skipped.sort_by_key(|i| i.begin);
 
-                        let used_lines = if PARSES_USED_LINES {
+                        let lines = if PARSES_USED_LINES {
                             skipped
                         } else {
                             interval::Interval::invert(&skipped, file.lines)
                         };
-                        let used_lines = used_lines
-                            .into_iter()
-                            .map(|i| Interval {
-                                start: i.begin,
-                                stop: i.end + 1,
-                                val: variant.clone(),
-                            })
-                            .collect();
-
-                        (file.path, used_lines)
-                    })
-                    .collect::<Vec<_>>()
-            })
-            .flatten()
-            .collect();
-
-        let mut temp = HashMap::<PathBuf, Vec<Interval>>::new();
-        for (file, used_lines) in infos {
-            match temp.entry(file) {
-                Entry::Occupied(mut entry) => {
-                    entry.get_mut().extend(used_lines);
-                }
-                Entry::Vacant(entry) => {
-                    entry.insert(used_lines);
-                }
-            };
-        }
+                        used_lines
+                            .entry(file.path)
+                            .or_default()
+                            .extend(lines.into_iter().map(|i| (i.begin, i.end + 1)));
+                    }
+                    Ok::<_, io::Error>((used_lines, resolved))
+                },
+            )
+            .try_reduce(
+                || (HashMap::new(), HashSet::new()),
+                |(a, _), (b, _)| {
+                    let (mut a, b) = if a.len() >= b.len() { (a, b) } else { (b, a) };
+                    for (file, ranges) in b {
+                        a.entry(file).or_default().append(ranges);
+                    }
+                    Ok((a, HashSet::new()))
+                },
+            )?;
 
-        let compact_data = temp
+        let compact_data = used_lines
             .into_par_iter()
-            .map(|(file, used_lines)| {
-                let mut tree = IntervalTree::new(used_lines);
-                tree.merge_overlaps();
-                (file, tree)
+            .map(|(file, ranges)| {
+                let segments = ranges
+                    .into_disjoint()
+                    .into_iter()
+                    .map(|(start, stop)| Segment {
+                        start,
+                        stop,
+                        val: VariantSet::single(0),
+                    })
+                    .collect();
+                (file, IntervalTree::new(segments))
             })
             .collect();
 
         Ok(Self {
             repo: repo.as_ref().to_owned(),
+            variants: vec![variant.clone()],
             used_lines: compact_data,
             commands: HashMap::from([(variant, compile_commands_hash)]),
         })
     }
 
+    /// Moves all files located below `from` to `to`
+    pub fn rebase<P: AsRef<Path>, Q: AsRef<Path>>(&mut self, from: P, to: Q) {
+        let (from, to) = (from.as_ref(), to.as_ref());
+
+        self.used_lines = std::mem::take(&mut self.used_lines)
+            .into_iter()
+            .map(|(file, tree)| {
+                if file.starts_with(from) {
+                    (to.join(file.strip_prefix(from).unwrap()), tree)
+                } else {
+                    (file, tree)
+                }
+            })
+            .collect();
+        self.repo = to.to_owned();
+    }
+
     fn get_all_variants(&self) -> Vec<String> {
         self.commands.keys().cloned().collect()
     }
@@ -110,53 +168,62 @@ impl<const PARSES_USED_LINES: bool> UsageStorage<PARSES_USED_LINES> {
         }
     }
 
-    fn find_variants_for_commit(dir: &Path, commit: &str) -> UsageStorage<PARSES_USED_LINES> {
-        let content = std::fs::read_to_string(dir.join(commit).with_extension("json")).unwrap();
-        serde_json::from_str(&content).unwrap()
+    pub fn load<P: AsRef<Path>>(
+        dir: P,
+        commit: &str,
+    ) -> Result<UsageStorage<PARSES_USED_LINES>, io::Error> {
+        Self::read_all(dir, commit)?.ok_or_else(|| {
+            io::Error::new(io::ErrorKind::NotFound, format!("no storage for {commit}"))
+        })
     }
 
+    /// Returns the affected variants and the changed files they use
+    ///
+    /// `compile_commands_map` maps variants to the hash of their current compilation database
     fn get_affected(
         storage: &UsageStorage<PARSES_USED_LINES>,
-        compile_commands_map: Option<Vec<String>>,
+        compile_commands_map: Option<HashMap<String, String>>,
         changes: &HashMap<PathBuf, Change>,
-    ) -> Vec<String> {
-        let changed_by_use = changes
-            .iter()
-            .filter_map(|(file, changed)| {
-                if let Some(used) = storage.used_lines.get(file) {
-                    let variants: HashSet<&String> = match changed {
-                        Change::Partly(changed_lines) => changed_lines
-                            .iter()
-                            .flat_map(|interval| {
-                                used.find(interval.start, interval.stop).map(|i| &i.val)
-                            })
-                            .collect(),
-                        Change::Full => used.iter().map(|i| &i.val).collect(),
-                    };
-                    Some(variants)
-                } else {
-                    None
+    ) -> (Vec<String>, Vec<PathBuf>) {
+        let mut used_by = VariantSet::default();
+        let mut files = vec![];
+        for (file, changed) in changes {
+            let Some(used) = storage.used_lines.get(file) else {
+                continue;
+            };
+
+            let mut variants = VariantSet::default();
+            match changed {
+                Change::Partly(changed_lines) => {
+                    for interval in changed_lines {
+                        for segment in used.find(interval.start, interval.stop) {
+                            variants.union_with(&segment.val);
+                        }
+                    }
                 }
-            })
-            .flatten();
+                Change::Full => {
+                    for segment in used.iter() {
+                        variants.union_with(&segment.val);
+                    }
+                }
+            }
 
-        let set: HashSet<&String> = if let Some(compile_commands_map) = compile_commands_map {
-            let variant_commands = compile_commands_map
-                .into_iter()
-                .map(|s| {
-                    let (v, p) = s.split_once(':').unwrap();
-                    (v.to_owned(), p.to_owned())
-                })
-                .collect::<HashMap<String, String>>();
+            if !variants.is_empty() {
+                used_by.union_with(&variants);
+                files.push(file.to_path_buf());
+            }
+        }
+
+        let changed_by_use = used_by.iter().map(|i| &storage.variants[i]);
 
+        let set: HashSet<&String> = if let Some(variant_commands) = compile_commands_map {
             let changed_by_cc = storage
                 .commands
                 .iter()
                 .filter_map(|(variant, old_commands)| {
                     if let Some(old_commands) = old_commands {
-                        if let Some(new_commands_path) = variant_commands.get(variant.as_str()) {
-                            let new_commands = CompileCommands::read(new_commands_path).unwrap();
-                            if old_commands != &new_commands {
+                        if let Some(new_commands) = variant_commands.get(variant.as_str()) {
+                            if old_commands != new_commands {
                                 debug!("{old_commands:?} -> {new_commands:?}");
                                 return Some(variant);
                             }
@@ -176,110 +243,399 @@ impl<const PARSES_USED_LINES: bool> UsageStorage<PARSES_USED_LINES> {
             changed_by_use.collect()
         };
 
-        set.into_iter().cloned().collect()
+        (set.into_iter().cloned().collect(), files)
     }
 
     pub fn find_affected_variants<P: AsRef<Path>>(
         dir: P,
         commit: &str,
-        compile_commands_map: Option<Vec<String>>,
+        compile_commands_map: Option<HashMap<String, String>>,
         changes: HashMap<PathBuf, Change>,
         alarm_list: Option<&Vec<PathBuf>>,
         filter_asm: bool,
     ) -> Result<Vec<String>, std::io::Error> {
-        let storage = Self::find_variants_for_commit(dir.as_ref(), commit);
+        let storage = Self::load(dir, commit)?;
 
+        Ok(storage
+            .affected_variants(compile_commands_map, &changes, alarm_list, filter_asm)
+            .0)
+    }
+
+    /// Returns the affected variants and the changed files responsible for it
+    pub fn affected_variants(
+        &self,
+        compile_commands_map: Option<HashMap<String, String>>,
+        changes: &HashMap<PathBuf, Change>,
+        alarm_list: Option<&Vec<PathBuf>>,
+        filter_asm: bool,
+    ) -> (Vec<String>, Vec<PathBuf>) {
         if filter_asm {
-            let asm_changed = changes.keys().any(|file| {
-                if let Some(ext) = file.extension() {
-                    let ext = ext.to_ascii_lowercase();
-                    ext == "s" || ext == "asm"
-                } else {
-                    false
-                }
-            });
-            if asm_changed {
-                return Ok(storage.get_all_variants());
+            let asm_changed: Vec<PathBuf> = changes
+                .keys()
+                .filter(|file| {
+                    if let Some(ext) = file.extension() {
+                        let ext = ext.to_ascii_lowercase();
+                        ext == "s" || ext == "asm"
+                    } else {
+                        false
+                    }
+                })
+                .cloned()
+                .collect();
+            if !asm_changed.is_empty() {
+                return (self.get_all_variants(), asm_changed);
             }
         }
 
         if let Some(alarm_list) = alarm_list {
-            let some_file_changed = alarm_list.iter().any(|file| {
-                let file = if file.is_relative() {
-                    storage.repo.join(file)
-                } else {
-                    file.to_path_buf()
-                };
-                changes.contains_key(&file)
-            });
+            let changed_alarms: Vec<PathBuf> = alarm_list
+                .iter()
+                .map(|file| {
+                    if file.is_relative() {
+                        self.repo.join(file)
+                    } else {
+                        file.to_path_buf()
+                    }
+                })
+                .filter(|file| changes.contains_key(file))
+                .collect();
 
-            if some_file_changed {
-                return Ok(storage.get_all_variants());
+            if !changed_alarms.is_empty() {
+                return (self.get_all_variants(), changed_alarms);
             }
         }
 
-        Ok(Self::get_affected(&storage, compile_commands_map, &changes))
+        Self::get_affected(self, compile_commands_map, changes)
     }
 
-    // TODO: make faster
     fn merge_into(
         old: &mut UsageStorage<PARSES_USED_LINES>,
         new: &UsageStorage<PARSES_USED_LINES>,
     ) {
         assert!(new.commands.keys().len() == 1);
         let new_variant = new.commands.keys().next().unwrap();
-        assert!(
-            !old.commands.contains_key(new_variant),
-            "{:?} -> {:?}",
-            old.commands,
-            new.commands
-        );
         old.commands.extend(new.commands.clone());
 
-        // maybe fold and reduce?
+        // the new variant is the only one of `new`, it becomes the next bit of `old`, unless it was dumped
+        // again after a rerun and replaces the lines it used before
+        let position = old
+            .variants
+            .iter()
+            .position(|variant| variant == new_variant);
+        let index = match position {
+            Some(index) => {
+                debug!("Replacing the used lines of {new_variant}");
+                old.remove_variant(index);
+                index
+            }
+            None => {
+                old.variants.push(new_variant.clone());
+                old.variants.len() - 1
+            }
+        };
+        let bit = VariantSet::single(index);
+
         for (npath, ntree) in &new.used_lines {
+            let segments: Vec<Segment> = ntree
+                .iter()
+                .map(|segment| Segment {
+                    start: segment.start,
+                    stop: segment.stop,
+                    val: bit.clone(),
+                })
+                .collect();
+
             match old.used_lines.entry(npath.to_path_buf()) {
                 Entry::Occupied(mut entry) => {
-                    // merge trees
-                    let old_data = entry.get().clone();
-                    let merged = old_data.into_iter().chain(ntree.clone()).collect();
-                    let merged = IntervalTree::new(merged);
-                    entry.insert(merged);
+                    let merged = merge_segments(&entry.get().intervals, &segments);
+                    entry.insert(IntervalTree::new(merged));
                 }
                 Entry::Vacant(entry) => {
-                    entry.insert(ntree.clone());
+                    entry.insert(IntervalTree::new(segments));
                 }
             }
         }
     }
 
-    pub fn dump_to_dir_accu<P: AsRef<Path>>(
+    /// Drops variant `index` from the used lines, keeping its bit
+    fn remove_variant(&mut self, index: usize) {
+        self.used_lines.retain(|_, tree| {
+            let segments: Vec<Segment> = tree
+                .iter()
+                .map(|segment| {
+                    let mut val = segment.val.clone();
+                    val.remove(index);
+                    Segment {
+                        start: segment.start,
+                        stop: segment.stop,
+                        val,
+                    }
+                })
+                .filter(|segment| !segment.val.is_empty())
+                .collect();
+            if segments.is_empty() {
+                return false;
+            }
+
+            // segments that only differed in the removed variant are adjacent now
+            *tree = IntervalTree::new(merge_segments(&segments, &[]));
+            true
+        });
+    }
+
+    /// Directory of the not yet compacted per-variant databases of `commit`
+    fn segment_dir<P: AsRef<Path>>(dir: P, commit: &str) -> PathBuf {
+        dir.as_ref().join(format!("{commit}.d"))
+    }
+
+    fn list_segments<P: AsRef<Path>>(
+        dir: P,
+        commit: &str,
+    ) -> Result<Vec<(PathBuf, StorageFormat)>, std::io::Error> {
+        let segment_dir = Self::segment_dir(dir, commit);
+        if !segment_dir.is_dir() {
+            return Ok(vec![]);
+        }
+
+        let mut segments = std::fs::read_dir(segment_dir)?
+            .map(|entry| entry.map(|entry| entry.path()))
+            .collect::<Result<Vec<_>, _>>()?
+            .into_iter()
+            .filter_map(|path| StorageFormat::from_path(&path).map(|format| (path, format)))
+            .collect::<Vec<_>>();
+        // merge in a stable order, so the variant bits do not depend on the directory order
+        segments.sort_by(|a, b| a.0.cmp(&b.0));
+        Ok(segments)
+    }
+
+    /// Files and directories that make up the database of `commit`, whether they exist or not
+    pub fn paths<P: AsRef<Path>>(dir: P, commit: &str) -> Vec<PathBuf> {
+        let dir = dir.as_ref();
+        vec![
+            dir.join(commit)
+                .with_extension(StorageFormat::Json.extension()),
+            dir.join(commit)
+                .with_extension(StorageFormat::Binary.extension()),
+            Self::segment_dir(dir, commit),
+        ]
+    }
+
+    pub fn exists<P: AsRef<Path>>(dir: P, commit: &str) -> bool {
+        Self::find(&dir, commit).is_some() || Self::segment_dir(&dir, commit).is_dir()
+    }
+
+    /// Reads the compacted database of `commit` and merges the variants dumped since the last compaction
+    pub fn read_all<P: AsRef<Path>>(
+        dir: P,
+        commit: &str,
+    ) -> Result<Option<UsageStorage<PARSES_USED_LINES>>, std::io::Error> {
+        let mut storage = match Self::find(&dir, commit) {
+            Some((path, format)) => Some(Self::read(path, format)?),
+            None => None,
+        };
+
+        for (path, format) in Self::list_segments(&dir, commit)? {
+            let segment = Self::read(path, format)?;
+            match &mut storage {
+                Some(storage) => UsageStorage::merge_into(storage, &segment),
+                None => storage = Some(segment),
+            }
+        }
+
+        Ok(storage)
+    }
+
+    /// Stores the single variant of `self` next to the database of `commit`, without touching other variants
+    pub fn dump_segment<P: AsRef<Path>>(
         &self,
-        path: P,
-        version: &str,
+        dir: P,
+        commit: &str,
+        format: StorageFormat,
     ) -> Result<(), std::io::Error> {
-        let filename = format!("{version}.json");
-        let file_path = path.as_ref().join(filename);
+        assert!(self.variants.len() == 1);
 
-        if file_path.exists() {
-            let content = std::fs::read_to_string(&file_path).unwrap();
-            let mut old = serde_json::from_str(&content).unwrap();
+        let segment_dir = Self::segment_dir(dir, commit);
+        std::fs::create_dir_all(&segment_dir)?;
 
-            UsageStorage::merge_into(&mut old, self);
+        // readers never see a partially written segment
+        let path = segment_dir.join(format!("{}.{}", self.variants[0], format.extension()));
+        let tmp_path = path.with_extension("tmp");
+        self.dump(&tmp_path, format)?;
+        std::fs::rename(tmp_path, path)
+    }
 
-            old.dump(file_path)
-        } else {
-            self.dump(file_path)
+    /// Merges all variants of `commit` into one database in `format` and removes the per-variant ones
+    pub fn compact<P: AsRef<Path>>(
+        dir: P,
+        commit: &str,
+        format: StorageFormat,
+    ) -> Result<(), std::io::Error> {
+        let old = Self::find(&dir, commit);
+        let segments = Self::list_segments(&dir, commit)?;
+        if segments.is_empty() && old.as_ref().map_or(true, |(_, f)| *f == format) {
+            return Ok(());
+        }
+
+        let storage = Self::read_all(&dir, commit)?.unwrap();
+        let path = dir.as_ref().join(commit).with_extension(format.extension());
+        let tmp_path = path.with_extension("tmp");
+        storage.dump(&tmp_path, format)?;
+        std::fs::rename(tmp_path, &path)?;
+
+        if let Some((old_path, _)) = old {
+            if old_path != path {
+                // the database was converted, do not leave a stale copy behind
+                std::fs::remove_file(old_path)?;
+            }
         }
+        std::fs::remove_dir_all(Self::segment_dir(&dir, commit))
     }
 
-    pub fn dump<P: AsRef<Path>>(&self, path: P) -> Result<(), std::io::Error> {
-        let serialized = if cfg!(debug_assertions) {
-            serde_json::to_string_pretty(&self)?
-        } else {
-            serde_json::to_string(&self)?
+    pub fn dump<P: AsRef<Path>>(
+        &self,
+        path: P,
+        format: StorageFormat,
+    ) -> Result<(), std::io::Error> {
+        let serialized = match format {
+            StorageFormat::Json if cfg!(debug_assertions) => serde_json::to_vec_pretty(&self)?,
+            StorageFormat::Json => serde_json::to_vec(&self)?,
+            StorageFormat::Binary => self.to_binary(),
         };
 
         std::fs::write(path, serialized)
     }
 }
+
+/// `[start, stop)` line ranges of one file, coalesced whenever they doubled since the last time
+#[derive(Default)]
+struct UsedRanges {
+    ranges: Vec<(u32, u32)>,
+    coalesced: usize,
+}
+
+impl UsedRanges {
+    fn extend<I: IntoIterator<Item = (u32, u32)>>(&mut self, ranges: I) {
+        self.ranges.extend(ranges);
+        if self.ranges.len() > 2 * self.coalesced.max(32) {
+            self.coalesce();
+        }
+    }
+
+    fn append(&mut self, other: UsedRanges) {
+        self.extend(other.ranges);
+    }
+
+    /// Sorts the ranges and merges overlapping and adjacent ones, like `Lapper::merge_overlaps`
+    fn coalesce(&mut self) {
+        self.ranges.sort_unstable();
+
+        let mut last = 0;
+        for i in 1..self.ranges.len() {
+            let (start, stop) = self.ranges[i];
+            if start <= self.ranges[last].1 {
+                self.ranges[last].1 = self.ranges[last].1.max(stop);
+            } else {
+                last += 1;
+                self.ranges[last] = (start, stop);
+            }
+        }
+        self.ranges.truncate(last + 1);
+        self.coalesced = self.ranges.len();
+    }
+
+    fn into_disjoint(mut self) -> Vec<(u32, u32)> {
+        self.coalesce();
+        self.ranges
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn coalesce_ranges() {
+        let mut ranges = UsedRanges::default();
+        ranges.extend([(5, 8), (1, 3), (3, 4)]);
+        ranges.append(UsedRanges {
+            ranges: vec![(7, 10), (12, 13), (2, 3)],
+            coalesced: 0,
+        });
+
+        assert_eq!(ranges.into_disjoint(), vec![(1, 4), (5, 10), (12, 13)]);
+    }
+
+    fn storage(variants: &[&str], lines: Vec<(&str, u32, u32, &[usize])>) -> UsageStorage<true> {
+        let mut used_lines: HashMap<PathBuf, Vec<Segment>> = HashMap::new();
+        for (file, start, stop, indices) in lines {
+            let mut val = VariantSet::default();
+            for &index in indices {
+                val.union_with(&VariantSet::single(index));
+            }
+            used_lines
+                .entry(PathBuf::from(file))
+                .or_default()
+                .push(Segment { start, stop, val });
+        }
+
+        UsageStorage {
+            repo: PathBuf::from("/repo"),
+            variants: variants.iter().map(|variant| variant.to_string()).collect(),
+            used_lines: used_lines
+                .into_iter()
+                .map(|(file, segments)| (file, IntervalTree::new(segments)))
+                .collect(),
+            commands: variants
+                .iter()
+                .map(|variant| (variant.to_string(), None))
+                .collect(),
+        }
+    }
+
+    fn lines(storage: &UsageStorage<true>, file: &str) -> Vec<(u32, u32, Vec<usize>)> {
+        storage.used_lines[Path::new(file)]
+            .iter()
+            .map(|segment| (segment.start, segment.stop, segment.val.iter().collect()))
+            .collect()
+    }
+
+    // eval/test_lrdb.py checks `LRDB.affected` against the same fixture
+    #[test]
+    fn affected_check_fixture() {
+        let dir = Path::new(env!("CARGO_MANIFEST_DIR")).join("test/check");
+        let storage =
+            UsageStorage::<true>::read(dir.join("base.json"), StorageFormat::Json).unwrap();
+        let entry = crate::diff_cache::DiffCacheEntry::read(&dir, "base", "change").unwrap();
+        let expected: serde_json::Value =
+            serde_json::from_reader(File::open(dir.join("expected.json")).unwrap()).unwrap();
+
+        let (mut variants, mut files) =
+            storage.affected_variants(None, &entry.changes(&storage.repo), None, true);
+        variants.sort();
+        files.sort();
+        assert_eq!(serde_json::json!(variants), expected["affected"]);
+        assert_eq!(serde_json::json!(files), expected["files"]);
+    }
+
+    #[test]
+    fn merge_dumped_again() {
+        let mut old = storage(
+            &["a", "b"],
+            vec![
+                ("x.c", 1, 5, &[0, 1]),
+                ("x.c", 5, 8, &[1]),
+                ("y.c", 1, 3, &[0]),
+            ],
+        );
+        let new = storage(&["a"], vec![("x.c", 6, 10, &[0])]);
+
+        UsageStorage::merge_into(&mut old, &new);
+
+        assert_eq!(old.variants, vec!["a", "b"]);
+        assert_eq!(
+            lines(&old, "x.c"),
+            vec![(1, 6, vec![1]), (6, 8, vec![0, 1]), (8, 10, vec![0])]
+        );
+        assert!(!old.used_lines.contains_key(Path::new("y.c")));
+    }
+}
@@ -0,0 +1,158 @@
+use serde::Deserialize;
+use serde::Serialize;
+
+/// Bitset of variants, bit `i` refers to `UsageStorage::variants[i]`
+///
+/// Sets never carry trailing zero words, so equal sets compare equal.
+#[derive(Clone, Debug, Default, PartialEq, Eq, Hash, Deserialize, Serialize)]
+#[serde(transparent)]
+pub struct VariantSet(Vec<u64>);
+
+impl VariantSet {
+    pub fn single(variant: usize) -> Self {
+        let mut words = vec![0; variant / 64 + 1];
+        words[variant / 64] = 1 << (variant % 64);
+        Self(words)
+    }
+
+    pub fn from_words(mut words: Vec<u64>) -> Self {
+        while words.last() == Some(&0) {
+            words.pop();
+        }
+        Self(words)
+    }
+
+    pub fn words(&self) -> &[u64] {
+        &self.0
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.0.is_empty()
+    }
+
+    pub fn union_with(&mut self, other: &VariantSet) {
+        if self.0.len() < other.0.len() {
+            self.0.resize(other.0.len(), 0);
+        }
+        for (word, other) in self.0.iter_mut().zip(&other.0) {
+            *word |= other;
+        }
+    }
+
+    pub fn remove(&mut self, variant: usize) {
+        if let Some(word) = self.0.get_mut(variant / 64) {
+            *word &= !(1 << (variant % 64));
+        }
+        while self.0.last() == Some(&0) {
+            self.0.pop();
+        }
+    }
+
+    /// Indices of the contained variants in ascending order
+    pub fn iter(&self) -> impl Iterator<Item = usize> + '_ {
+        self.0.iter().enumerate().flat_map(|(i, &word)| {
+            (0..64)
+                .filter(move |bit| word & (1u64 << bit) != 0)
+                .map(move |bit| i * 64 + bit)
+        })
+    }
+}
+
+/// Merges two lists of disjoint segments, sorted by start, into one list of disjoint segments
+///
+/// Lines used by both lists are tagged with the union of both sets, adjacent segments with equal sets are
+/// coalesced.
+pub fn merge_segments(a: &[super::Segment], b: &[super::Segment]) -> Vec<super::Segment> {
+    let mut points: Vec<u32> = a
+        .iter()
+        .chain(b)
+        .flat_map(|segment| [segment.start, segment.stop])
+        .collect();
+    points.sort_unstable();
+    points.dedup();
+
+    let (mut i, mut j) = (0, 0);
+    let mut merged: Vec<super::Segment> = Vec::with_capacity(a.len().max(b.len()));
+    for bounds in points.windows(2) {
+        let (start, stop) = (bounds[0], bounds[1]);
+        while i < a.len() && a[i].stop <= start {
+            i += 1;
+        }
+        while j < b.len() && b[j].stop <= start {
+            j += 1;
+        }
+
+        let mut val = VariantSet::default();
+        if i < a.len() && a[i].start <= start {
+            val.union_with(&a[i].val);
+        }
+        if j < b.len() && b[j].start <= start {
+            val.union_with(&b[j].val);
+        }
+        if val.is_empty() {
+            continue;
+        }
+
+        match merged.last_mut() {
+            Some(last) if last.stop == start && last.val == val => last.stop = stop,
+            _ => merged.push(super::Segment { start, stop, val }),
+        }
+    }
+
+    merged
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::plugin::Segment;
+
+    fn segment(start: u32, stop: u32, variants: &[usize]) -> Segment {
+        let mut val = VariantSet::default();
+        for &variant in variants {
+            val.union_with(&VariantSet::single(variant));
+        }
+        Segment { start, stop, val }
+    }
+
+    #[test]
+    fn set_iter() {
+        let mut set = VariantSet::single(3);
+        set.union_with(&VariantSet::single(70));
+        assert_eq!(set.iter().collect::<Vec<_>>(), vec![3, 70]);
+        assert_eq!(VariantSet::from_words(vec![1, 0]), VariantSet::single(0));
+
+        set.remove(70);
+        assert_eq!(set, VariantSet::single(3));
+    }
+
+    // Interval equality ignores the value
+    fn flatten(segments: Vec<Segment>) -> Vec<(u32, u32, Vec<usize>)> {
+        segments
+            .into_iter()
+            .map(|segment| (segment.start, segment.stop, segment.val.iter().collect()))
+            .collect()
+    }
+
+    #[test]
+    fn merge_overlapping() {
+        let a = [segment(1, 10, &[0])];
+        let b = [segment(5, 15, &[1])];
+
+        assert_eq!(
+            flatten(merge_segments(&a, &b)),
+            vec![(1, 5, vec![0]), (5, 10, vec![0, 1]), (10, 15, vec![1])]
+        );
+    }
+
+    #[test]
+    fn merge_coalesce() {
+        let a = [segment(1, 5, &[0, 1]), segment(8, 9, &[0])];
+        let b = [segment(1, 3, &[1]), segment(5, 8, &[0])];
+
+        assert_eq!(
+            flatten(merge_segments(&a, &b)),
+            vec![(1, 5, vec![0, 1]), (5, 9, vec![0])]
+        );
+    }
+}
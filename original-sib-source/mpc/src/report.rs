@@ -0,0 +1,73 @@
+use std::collections::BTreeMap;
+use std::fs::File;
+use std::io::{BufWriter, Write};
+use std::path::{Path, PathBuf};
+use std::time::Instant;
+
+use serde::Serialize;
+
+#[derive(clap::ValueEnum, Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Format {
+    /// Log messages only
+    Text,
+    /// One JSON object per result, written to `--output`
+    Json,
+}
+
+/// Machine-readable result of a single analysis
+#[derive(Debug, Default, Serialize)]
+pub struct Report {
+    pub commit: Option<String>,
+    pub change: Option<String>,
+    pub affected: Option<Vec<String>>,
+    /// Changed files that are used by an affected variant
+    pub files: Vec<PathBuf>,
+    pub error: Option<String>,
+    /// Seconds spent per phase
+    pub timings: BTreeMap<&'static str, f64>,
+}
+
+impl Report {
+    pub fn new(commit: Option<String>, change: Option<String>) -> Self {
+        Self {
+            commit,
+            change,
+            ..Default::default()
+        }
+    }
+
+    pub fn time<T, F: FnOnce() -> T>(&mut self, phase: &'static str, f: F) -> T {
+        let now = Instant::now();
+        let result = f();
+        *self.timings.entry(phase).or_default() += Instant::now().duration_since(now).as_secs_f64();
+        result
+    }
+
+    pub fn set_affected(&mut self, mut variants: Vec<String>, mut files: Vec<PathBuf>) {
+        variants.sort();
+        variants.dedup();
+        files.sort();
+
+        self.affected = Some(variants);
+        self.files = files;
+    }
+}
+
+/// Writes reports as JSON lines, flushed after every report so that readers can consume them incrementally
+pub struct ReportWriter {
+    writer: BufWriter<File>,
+}
+
+impl ReportWriter {
+    pub fn create<P: AsRef<Path>>(path: P) -> Result<Self, std::io::Error> {
+        Ok(Self {
+            writer: BufWriter::new(File::create(path)?),
+        })
+    }
+
+    pub fn write(&mut self, report: &Report) -> Result<(), std::io::Error> {
+        serde_json::to_writer(&mut self.writer, report)?;
+        writeln!(self.writer)?;
+        self.writer.flush()
+    }
+}
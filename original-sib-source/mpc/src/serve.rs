@@ -0,0 +1,65 @@
+use std::io::BufRead;
+
+use clap::Parser;
+use log::{info, warn};
+use serde::Deserialize;
+
+use crate::report::{Report, ReportWriter};
+use crate::session::Session;
+use crate::{AnalyzeArgs, ServeArgs};
+
+/// One line of stdin: the arguments of `mpc analyze`, e.g. `{"argv": ["--commit", "...", "dir"]}`
+#[derive(Debug, Deserialize)]
+struct Request {
+    argv: Vec<String>,
+}
+
+#[derive(Parser, Debug)]
+#[command(no_binary_name = true)]
+struct RequestArgs {
+    #[command(flatten)]
+    analyze: AnalyzeArgs,
+}
+
+/// Answers every request with exactly one report, failed requests are reported by `error`
+pub fn serve(args: &ServeArgs) -> Result<(), std::io::Error> {
+    let mut session = Session::default();
+    let mut writer = ReportWriter::create(&args.output)?;
+
+    for line in std::io::stdin().lock().lines() {
+        let line = line?;
+        if line.trim().is_empty() {
+            continue;
+        }
+
+        let report = handle(&line, &mut session).unwrap_or_else(|error| {
+            warn!("{error}");
+            Report {
+                error: Some(error),
+                ..Default::default()
+            }
+        });
+        writer.write(&report)?;
+    }
+
+    info!("Input closed, exiting");
+    Ok(())
+}
+
+fn handle(line: &str, session: &mut Session) -> Result<Report, String> {
+    let request: Request = serde_json::from_str(line).map_err(|e| e.to_string())?;
+    let args = RequestArgs::try_parse_from(&request.argv)
+        .map_err(|e| e.to_string())?
+        .analyze;
+
+    if args.check_batch.is_some() {
+        return Err("--check-batch is not supported by serve".to_owned());
+    }
+    if args.compare_checkpoints {
+        return Err("--compare-checkpoints is not supported by serve".to_owned());
+    }
+
+    crate::analyze_in(&args, session)
+        .map(|(_, report)| report)
+        .map_err(|e| e.to_string())
+}
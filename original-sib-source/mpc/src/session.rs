@@ -0,0 +1,102 @@
+use std::collections::hash_map::Entry;
+use std::collections::HashMap;
+use std::io;
+use std::path::{Path, PathBuf};
+use std::rc::Rc;
+use std::time::SystemTime;
+
+use git2::Repository;
+use log::debug;
+
+use crate::plugin::CompileCommands;
+use crate::plugin::UsageStorage;
+use crate::PARSE_USED_LINES;
+
+type Storage = UsageStorage<PARSE_USED_LINES>;
+
+/// Modification times of the files a cached value was read from
+type Stamp = Vec<Option<SystemTime>>;
+
+fn modified(path: &Path) -> Option<SystemTime> {
+    std::fs::metadata(path).and_then(|m| m.modified()).ok()
+}
+
+/// Repositories, line range databases and compile command hashes shared by the analyses of one process
+///
+/// A single analysis uses a fresh session, `mpc serve` keeps one across requests. Cached files are reread
+/// as soon as they change on disk.
+#[derive(Default)]
+pub struct Session {
+    repos: HashMap<PathBuf, Repository>,
+    storages: HashMap<(PathBuf, String), (Stamp, Rc<Storage>)>,
+    compile_commands: HashMap<PathBuf, (Stamp, String)>,
+}
+
+impl Session {
+    pub fn repo(&mut self, path: &Path) -> Result<&Repository, git2::Error> {
+        match self.repos.entry(path.to_path_buf()) {
+            Entry::Occupied(entry) => Ok(entry.into_mut()),
+            Entry::Vacant(entry) => Ok(entry.insert(Repository::open(path)?)),
+        }
+    }
+
+    pub fn storage(&mut self, dir: &Path, commit: &str) -> Result<Rc<Storage>, io::Error> {
+        let stamp = Storage::paths(dir, commit)
+            .iter()
+            .map(|path| modified(path))
+            .collect();
+        let key = (dir.to_path_buf(), commit.to_owned());
+
+        if let Some((cached, storage)) = self.storages.get(&key) {
+            if *cached == stamp {
+                debug!("Using cached storage of {commit}");
+                return Ok(storage.clone());
+            }
+        }
+
+        let storage = Rc::new(Storage::load(dir, commit)?);
+        self.storages.insert(key, (stamp, storage.clone()));
+        Ok(storage)
+    }
+
+    pub fn compile_commands_hash(&mut self, path: &Path) -> Result<String, io::Error> {
+        let stamp = vec![modified(path)];
+
+        if let Some((cached, hash)) = self.compile_commands.get(path) {
+            if *cached == stamp {
+                return Ok(hash.clone());
+            }
+        }
+
+        let hash = CompileCommands::read(path)?;
+        self.compile_commands
+            .insert(path.to_path_buf(), (stamp, hash.clone()));
+        Ok(hash)
+    }
+
+    /// Hashes the compilation databases of a `--compile-commands-path-map` (`variant:path`) per variant
+    pub fn compile_commands_map(
+        &mut self,
+        map: Option<&[String]>,
+    ) -> Result<Option<HashMap<String, String>>, io::Error> {
+        let Some(map) = map else {
+            return Ok(None);
+        };
+
+        map.iter()
+            .map(|entry| {
+                let (variant, path) = entry.split_once(':').ok_or_else(|| {
+                    io::Error::new(
+                        io::ErrorKind::InvalidInput,
+                        format!("{entry} is not variant:path"),
+                    )
+                })?;
+                Ok((
+                    variant.to_owned(),
+                    self.compile_commands_hash(Path::new(path))?,
+                ))
+            })
+            .collect::<Result<HashMap<_, _>, io::Error>>()
+            .map(Some)
+    }
+}
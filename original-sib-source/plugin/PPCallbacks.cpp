@@ -1,17 +1,81 @@
 #include "PPCallbacks.hpp"
 
 #include <clang/Basic/FileManager.h>
+#include <llvm/ADT/StringExtras.h>
+#include <llvm/Support/FileSystem.h>
 #include <llvm/Support/JSON.h>
+#include <llvm/Support/Path.h>
+#include <llvm/Support/xxhash.h>
 
 #include <llvm/Support/raw_ostream.h>
 
+#include <chrono>
+#include <cstdlib>
 #include <fstream>
 #include <unistd.h>
 
 using namespace std;
 using namespace llvm;
 
+// Writes Record to Store unless an earlier translation unit did, returns its key or an empty string on failure
+static string storeRecord(const string &Store, const string &Record) {
+  const string Key = utohexstr(xxHash64(Record), /*LowerCase=*/true);
+  const string Path = Store + "/" + Key + ".json";
+  if (sys::fs::exists(Path)) {
+    return Key;
+  }
+
+  // parallel compilers may write the same record, renaming makes every write atomic
+  const string TmpPath = Path + "." + to_string(getpid());
+  {
+    error_code EC;
+    raw_fd_ostream Stream(TmpPath, EC);
+    if (EC) {
+      errs() << EC.message() << '\n';
+      return "";
+    }
+    Stream << Record;
+  }
+  if (error_code EC = sys::fs::rename(TmpPath, Path)) {
+    errs() << EC.message() << '\n';
+    return "";
+  }
+  return Key;
+}
+
+namespace {
+// Adds the time until the end of the scope to Elapsed
+class ScopedTimer {
+  chrono::steady_clock::duration &Elapsed;
+  const chrono::steady_clock::time_point Start = chrono::steady_clock::now();
+
+public:
+  explicit ScopedTimer(chrono::steady_clock::duration &Elapsed) : Elapsed(Elapsed) {}
+  ~ScopedTimer() { Elapsed += chrono::steady_clock::now() - Start; }
+};
+} // namespace
+
+string MyPPCallbacks::getCanonicalName(const FileEntry *FE) {
+  FileManager &FM = SM.getFileManager();
+  const StringRef Name = FE->getName();
+
+  // only symlinked files need a full resolution, the directories are resolved once per translation unit
+  if (sys::fs::is_symlink_file(Name)) {
+    return FM.getCanonicalName(FE).str();
+  }
+
+  const auto Entry = CanonicalDirs.try_emplace(FE->getDir());
+  if (Entry.second) {
+    Entry.first->second = FM.getCanonicalName(FE->getDir()).str();
+  }
+
+  SmallString<256> Path(Entry.first->second);
+  sys::path::append(Path, sys::path::filename(Name));
+  return string(Path);
+}
+
 void MyPPCallbacks::SourceRangeSkipped(SourceRange Range, SourceLocation EndifLoc) {
+  ScopedTimer Timer(Elapsed);
   const SourceLocation Loc = Range.getBegin();
   assert(SM.getFileID(Loc) == SM.getFileID(Range.getEnd()));
 
@@ -25,6 +89,7 @@ void MyPPCallbacks::SourceRangeSkipped(SourceRange Range, SourceLocation EndifLo
 
 void MyPPCallbacks::FileChanged(SourceLocation Loc, FileChangeReason Reason, SrcMgr::CharacteristicKind FileType,
                                 FileID PrevFID) {
+  ScopedTimer Timer(Elapsed);
   if (Reason != FileChangeReason::EnterFile) {
     return;
   }
@@ -38,27 +103,43 @@ void MyPPCallbacks::FileChanged(SourceLocation Loc, FileChangeReason Reason, Src
 }
 
 void MyPPCallbacks::EndOfMainFile() {
-  const std::string PPID{std::to_string(getppid())};
-  const std::string FilePath = "/proc/" + PPID + "/cmdline";
-  std::ifstream CommandLine{FilePath};
-  std::string largs;
-  if (CommandLine.good()) {
-    std::string Arg;
-    do {
-      getline(CommandLine, Arg, '\0');
-      largs.append(Arg + ' ');
-    } while (Arg.size());
+  // the command line is only of interest when debugging, reading it costs a file per translation unit
+  string args;
+  const bool RecordArgs = getenv("SIB_RECORD_ARGS") != nullptr;
+  if (RecordArgs) {
+    const std::string PPID{std::to_string(getppid())};
+    const std::string FilePath = "/proc/" + PPID + "/cmdline";
+    std::ifstream CommandLine{FilePath};
+    std::string largs;
+    if (CommandLine.good()) {
+      std::string Arg;
+      do {
+        getline(CommandLine, Arg, '\0');
+        largs.append(Arg + ' ');
+      } while (Arg.size());
+    }
+    args = largs.substr(0, largs.length() - 2);
   }
 
-  const std::string args = largs.substr(0, largs.length() - 2);
+  writeInfo(RecordArgs ? &args : nullptr);
+
+  // the seconds spent in the plugin are appended per translation unit, O_APPEND keeps parallel writes apart
+  if (const char *Times = getenv("SIB_PLUGIN_TIMES")) {
+    error_code EC;
+    raw_fd_ostream Stream(Times, EC, sys::fs::OF_Append);
+    if (!EC) {
+      Stream << chrono::duration<double>(Elapsed).count() << '\n';
+    }
+  }
+}
+
+void MyPPCallbacks::writeInfo(const string *args) {
+  ScopedTimer Timer(Elapsed);
   const FileID MainFileID = SM.getMainFileID();
 
   // Compute filename
-  FileManager &FM = SM.getFileManager();
   // const StringRef MainFilename = SM.getFilename(SM.getComposedLoc(MainFileID, 0));
-  // TODO: This is a very expensive operation, despite its results being cached, and should only be used when the
-  // physical layout of the file system is required, which is (almost) never.
-  const StringRef MainFilename = FM.getCanonicalName(SM.getFileEntryForID(MainFileID));
+  const string MainFilename = getCanonicalName(SM.getFileEntryForID(MainFileID));
   // const FileEntry *MainFileEntry = SM.getFileEntryForID(MainFileID);
   // const StringRef path = FM.getCanonicalName(MainFileEntry);
 
@@ -71,42 +152,61 @@ void MyPPCallbacks::EndOfMainFile() {
 
   json::OStream W(Stream);
 
+  // records shared by many translation units, e.g. common headers, are written once and referred to by key
+  const char *Store = getenv("SIB_INFO_STORE");
+
   W.object([&] {
     W.attribute("tu", MainFilename);
-    W.attribute("args", args);
+    if (args) {
+      W.attribute("args", *args);
+    }
     if (this->Commit.has_value()) {
       W.attribute("commit", this->Commit);
     }
     if (this->Variant.has_value()) {
       W.attribute("variant", this->Variant);
     }
+    if (Store) {
+      W.attribute("store", Store);
+    }
     W.attributeArray("files", [&] {
       for (const auto &entry : R) {
         const FileID FID = entry.first;
         const vector<SourceRange> Ranges = entry.second;
 
         // const FileEntry *FileEntry = SM.getFileEntryForID(FID);
-        const StringRef Filename = FM.getCanonicalName(SM.getFileEntryForID(FID));
+        const string Filename = getCanonicalName(SM.getFileEntryForID(FID));
         const SourceLocation EndOfFile = SM.getLocForEndOfFile(FID);
         const unsigned int Lines = SM.getSpellingLineNumber(EndOfFile) - 1;
 
-        W.object([&] {
-          W.attribute("lines", Lines);
-          W.attribute("path", Filename);
-          W.attributeArray("skips", [&] {
+        string Record;
+        raw_string_ostream RecordStream(Record);
+        json::OStream RW(RecordStream);
+        RW.object([&] {
+          RW.attribute("lines", Lines);
+          RW.attribute("path", Filename);
+          RW.attributeArray("skips", [&] {
             for (const auto &Range : Ranges) {
               // remove PP directives from skips
               const auto begin = SM.getSpellingLineNumber(Range.getBegin()) + 1;
               const auto end = SM.getSpellingLineNumber(Range.getEnd()) - 1;
               if (begin <= end) {
-                W.array([&] {
-                  W.value(begin);
-                  W.value(end);
+                RW.array([&] {
+                  RW.value(begin);
+                  RW.value(end);
                 });
               }
             }
           });
         });
+        RecordStream.flush();
+
+        const string Key = Store ? storeRecord(Store, Record) : "";
+        if (Key.empty()) {
+          W.rawValue(Record);
+        } else {
+          W.object([&] { W.attribute("ref", Key); });
+        }
       }
     });
   });
@@ -3,6 +3,8 @@
 
 #include <llvm/ADT/DenseMap.h>
 
+#include <chrono>
+
 #include <clang/Basic/SourceManager.h>
 #include <clang/Frontend/CompilerInstance.h>
 #include <clang/Lex/PPCallbacks.h>
@@ -23,6 +25,12 @@ private:
   const CompilerInstance &CI;
   const SourceManager &SM;
   llvm::DenseMap<FileID, std::vector<SourceRange>> R;
+  llvm::DenseMap<const DirectoryEntry *, std::string> CanonicalDirs;
+  // time spent in the callbacks of this translation unit
+  std::chrono::steady_clock::duration Elapsed{};
+
+  std::string getCanonicalName(const FileEntry *FE);
+  void writeInfo(const std::string *args);
 
 public:
 #if __clang_major__ >= 17